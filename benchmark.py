@@ -0,0 +1,154 @@
+# parse_message 性能测试：和原来的实现对比，使用很长、entity 很多的消息
+# 用法：python benchmark.py [实体数量...]
+import ast
+import random
+import re
+import sys
+import timeit
+from bisect import bisect_left
+
+from telebot.types import MessageEntity, User
+
+
+# 原来的实现，O(n²)，并且直接用 UTF-16 的 offset 截取 str
+def legacy_parse_message(text, entities):
+    if not entities:
+        return [{
+            'type': 'text',
+            'id': None,
+            'content': text
+        }]
+    else:
+        message_local = []
+        for entity in entities:
+            if entity == entities[0]:
+                if text[:entity.offset] != '':
+                    message_local.append({
+                        'type': 'text',
+                        'id': None,
+                        'content': text[:entity.offset].strip()
+                    })
+
+            if entity.type == 'mention':
+                user_name = text[entity.offset + 1:entity.offset + entity.length]
+                message_local.append({'type': 'at',
+                                      'id': get_id_by_tg_username(user_name),
+                                      'content': user_name,
+                                      })
+            elif entity.type == 'text_mention':
+                message_local.append({'type': 'at',
+                                      'id': entity.user.id,
+                                      'content': get_tg_username_by_id_noformat(entity.user.id)})
+            else:
+                message_local.append({
+                    'type': 'text',
+                    'id': None,
+                    'content': text[entity.offset:entity.offset + entity.length]
+                })
+
+            if entity != entities[-1]:
+                if text[entity.offset + entity.length:entities[entities.index(entity) + 1].offset] != '':
+                    message_local.append({
+                        'type': 'text',
+                        'id': None,
+                        'content': text[entity.offset + entity.length:entities[
+                            entities.index(entity) + 1].offset].strip()
+                    })
+            else:
+                if text[entity.offset + entity.length:] != '':
+                    message_local.append({
+                        'type': 'text',
+                        'id': None,
+                        'content': text[entity.offset + entity.length:].strip()
+                    })
+
+        return message_local
+
+
+def get_id_by_tg_username(user_name):
+    return None
+
+
+def get_tg_username_by_id_noformat(user_id):
+    return str(user_id)
+
+
+# 从 main.py 里取出 parse_message 和它用到的 astral_pattern（直接 import main.py 会启动机器人）
+def load_parse_message():
+    with open('main.py', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    nodes = [node for node in tree.body
+             if isinstance(node, ast.FunctionDef) and node.name == 'parse_message'
+             or isinstance(node, ast.Assign) and any(getattr(target, 'id', None) == 'astral_pattern'
+                                                     for target in node.targets)]
+    namespace = {'re': re, 'bisect_left': bisect_left,
+                 'get_id_by_tg_username': get_id_by_tg_username,
+                 'get_tg_username_by_id_noformat': get_tg_username_by_id_noformat}
+    exec(compile(ast.Module(nodes, []), 'main.py', 'exec'), namespace)
+    return namespace['parse_message']
+
+
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+# 生成一条有 count 个 entity 的消息，emoji 为 True 时文本里夹杂 emoji
+def make_message(count, emoji, seed=0):
+    rng = random.Random(seed)
+    words = ['hello', '苦力怕', 'creeper', '钻石', 'nether'] + (['🥵', '😂👍', '🏳️‍🌈'] if emoji else [])
+    parts = []
+    entities = []
+    offset = 0
+    for i in range(count):
+        gap = ' ' + ' '.join(rng.choice(words) for _ in range(rng.randint(1, 4))) + ' '
+        parts.append(gap)
+        offset += utf16_len(gap)
+        kind = rng.choice(['mention', 'text_mention', 'bold'])
+        if kind == 'mention':
+            piece = f'@user{i}'
+            entity = MessageEntity('mention', offset, utf16_len(piece))
+        elif kind == 'text_mention':
+            piece = f'玩家{i}'
+            entity = MessageEntity('text_mention', offset, utf16_len(piece), user=User(i, False, piece))
+        else:
+            piece = rng.choice(words) + 'bold'
+            entity = MessageEntity('bold', offset, utf16_len(piece))
+        parts.append(piece)
+        entities.append(entity)
+        offset += utf16_len(piece)
+    parts.append(' end')
+    return ''.join(parts), entities
+
+
+def bench(func, text, entities):
+    timer = timeit.Timer(lambda: func(text, entities))
+    number, _ = timer.autorange()
+    return min(timer.repeat(3, number)) / number
+
+
+def main():
+    parse_message = load_parse_message()
+    counts = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000]
+
+    # 没有 emoji 时两个实现的结果应该一样
+    text, entities = make_message(200, emoji=False)
+    assert parse_message(text, entities) == legacy_parse_message(text, entities)
+    # 有 emoji 时原来的实现会截错位置
+    text, entities = make_message(200, emoji=True)
+    mentions = [segment['content'] for segment in parse_message(text, entities) if segment['type'] == 'at']
+    legacy_mentions = [segment['content'] for segment in legacy_parse_message(text, entities)
+                       if segment['type'] == 'at']
+    wrong = sum(a != b for a, b in zip(mentions, legacy_mentions))
+    print(f'emoji 消息里原来的实现截错了 {wrong}/{len(mentions)} 个 @')
+
+    print(f'{"entity 数":>10} {"emoji":>6} {"原实现 (ms)":>12} {"新实现 (ms)":>12} {"加速":>8}')
+    for count in counts:
+        for emoji in (False, True):
+            text, entities = make_message(count, emoji)
+            old = bench(legacy_parse_message, text, entities) * 1000
+            new = bench(parse_message, text, entities) * 1000
+            print(f'{count:>10} {str(emoji):>6} {old:>12.3f} {new:>12.3f} {old / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+# 本地的假 Telegram Bot API 服务器，用来测试 webhook / 轮询模式
+# 机器人的 config.json 里设置 "api_url": "http://127.0.0.1:8081/bot{0}/{1}"，然后运行：
+#   python fake_bot_api.py --updates 200
+# 机器人调用 setWebhook 后会把更新推送到 webhook 地址，否则通过 getUpdates 发给机器人
+# 推送的是私聊里的 /getID 命令，统计从推送更新到收到机器人回复的延迟
+import argparse
+import json
+import queue
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+import requests
+
+
+class FakeBotAPI:
+    def __init__(self, listen='127.0.0.1', port=8081, latency=0.0, rate_limit=0.0):
+        # 每个请求额外的延迟（秒）
+        self.latency = latency
+        # 返回 429 的概率
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_ready = threading.Event()
+        self.polling_ready = threading.Event()
+        self.updates = queue.Queue()
+        self.update_id = 0
+        self.message_id = 0
+        # 推送的消息 id -> 推送时间 / 收到回复的时间
+        self.pushed = {}
+        self.replied = {}
+        self.sent = []
+        self.replies_done = threading.Condition(self.lock)
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                status, body = api.handle(self)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((listen, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    @staticmethod
+    def params(request):
+        url = urlparse(request.path)
+        params = dict(parse_qsl(url.query))
+        length = int(request.headers.get('Content-Length') or 0)
+        if length:
+            body = request.rfile.read(length).decode('utf-8', 'replace')
+            if 'json' in (request.headers.get('Content-Type') or ''):
+                params.update(json.loads(body))
+            elif 'form-data' not in (request.headers.get('Content-Type') or ''):
+                params.update(parse_qsl(body))
+        return url.path.rsplit('/', 1)[-1], params
+
+    def handle(self, request):
+        method, params = self.params(request)
+        with self.lock:
+            self.calls[method] += 1
+        if method != 'getUpdates':
+            if self.latency:
+                time.sleep(self.latency)
+            if self.rate_limit and random.random() < self.rate_limit:
+                with self.lock:
+                    self.calls['429'] += 1
+                return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                             'parameters': {'retry_after': 1}}
+        handler = getattr(self, 'api_' + method, None)
+        result = handler(params) if handler else True
+        return 200, {'ok': True, 'result': result}
+
+    def next_message_id(self):
+        with self.lock:
+            self.message_id += 1
+            return self.message_id
+
+    @staticmethod
+    def chat(chat_id):
+        chat_id = int(chat_id)
+        if chat_id < 0:
+            return {'id': chat_id, 'type': 'supergroup', 'title': 'group'}
+        return {'id': chat_id, 'type': 'private', 'username': f'user{chat_id}', 'first_name': f'user{chat_id}'}
+
+    def api_getMe(self, params):
+        return {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'fake_bot'}
+
+    def api_setWebhook(self, params):
+        # remove_webhook 也是调用 setWebhook，只是 url 为空
+        self.webhook_url = params.get('url') or None
+        self.webhook_secret = params.get('secret_token')
+        if self.webhook_url:
+            self.webhook_ready.set()
+        return True
+
+    def api_deleteWebhook(self, params):
+        self.webhook_url = None
+        return True
+
+    def api_getUpdates(self, params):
+        self.polling_ready.set()
+        timeout = float(params.get('timeout') or 0)
+        updates = []
+        try:
+            updates.append(self.updates.get(timeout=min(timeout, 5)))
+            while len(updates) < 100:
+                updates.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return updates
+
+    def api_sendMessage(self, params):
+        message_id = self.next_message_id()
+        message = {'message_id': message_id, 'date': int(time.time()), 'chat': self.chat(params['chat_id']),
+                   'text': str(params.get('text', ''))}
+        reply_id = params.get('reply_to_message_id')
+        if params.get('reply_parameters'):
+            reply_id = json.loads(params['reply_parameters']).get('message_id')
+        with self.lock:
+            self.sent.append((time.monotonic(), params['chat_id'], message['text']))
+            if reply_id is not None:
+                reply_id = int(reply_id)
+                message['reply_to_message'] = {'message_id': reply_id, 'date': message['date'],
+                                               'chat': message['chat'], 'text': ''}
+                if reply_id in self.pushed and reply_id not in self.replied:
+                    self.replied[reply_id] = time.monotonic()
+                    self.replies_done.notify_all()
+        return message
+
+    def api_editMessageText(self, params):
+        return {'message_id': int(params.get('message_id', 0)), 'date': int(time.time()),
+                'chat': self.chat(params['chat_id']), 'text': str(params.get('text', ''))}
+
+    def api_getChat(self, params):
+        return self.chat(params['chat_id'])
+
+    def api_getFile(self, params):
+        return {'file_id': params['file_id'], 'file_unique_id': params['file_id'],
+                'file_path': f'photos/{params["file_id"]}.jpg'}
+
+    # 生成一条文本消息的更新
+    def text_update(self, chat_id, user_id, text):
+        message_id = self.next_message_id()
+        with self.lock:
+            self.update_id += 1
+            update_id = self.update_id
+        message = {'message_id': message_id, 'date': int(time.time()), 'chat': self.chat(chat_id),
+                   'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}',
+                            'username': f'user{user_id}'},
+                   'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': update_id, 'message': message}
+
+    # 把更新发给机器人：有 webhook 就推送，否则放进 getUpdates 的队列
+    def push(self, update):
+        with self.lock:
+            self.pushed[update['message']['message_id']] = time.monotonic()
+        if not self.webhook_url:
+            self.updates.put(update)
+            return
+        headers = {'X-Telegram-Bot-Api-Secret-Token': self.webhook_secret} if self.webhook_secret else {}
+        while True:
+            response = requests.post(self.webhook_url, json=update, headers=headers, timeout=10)
+            with self.lock:
+                self.calls[f'webhook {response.status_code}'] += 1
+            # 和 Telegram 一样，失败了稍后重发
+            if response.status_code == 200:
+                return
+            time.sleep(0.5)
+
+    def wait_replies(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while len(self.replied) < count and time.monotonic() < deadline:
+                self.replies_done.wait(deadline - time.monotonic())
+            return len(self.replied)
+
+    def latencies(self):
+        with self.lock:
+            return sorted(self.replied[message_id] - self.pushed[message_id] for message_id in self.replied)
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='假的 Telegram Bot API 服务器')
+    parser.add_argument('--listen', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--updates', type=int, default=100, help='推送多少条 /getID')
+    parser.add_argument('--rate', type=float, default=50, help='每秒推送多少条')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个 API 请求的额外延迟（秒）')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='返回 429 的概率')
+    parser.add_argument('--wait', type=float, default=60, help='等待机器人连接的时间（秒）')
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.listen, args.port, args.latency, args.rate_limit)
+    api.start()
+    print(f'假 Bot API 已启动：http://{args.listen}:{args.port}/bot{{0}}/{{1}}')
+
+    deadline = time.monotonic() + args.wait
+    while not (api.webhook_ready.is_set() or api.polling_ready.is_set()):
+        if time.monotonic() > deadline:
+            print('机器人没有连接')
+            return
+        time.sleep(0.1)
+    print('模式：' + (f'webhook {api.webhook_url}' if api.webhook_url else 'getUpdates 轮询'))
+
+    start = time.monotonic()
+    for i in range(args.updates):
+        # 每条来自不同的私聊，避免被单个聊天的限速影响
+        user_id = 1000 + i
+        api.push(api.text_update(user_id, user_id, '/getID'))
+        time.sleep(max(0.0, start + (i + 1) / args.rate - time.monotonic()))
+    replied = api.wait_replies(args.updates, 30)
+    elapsed = time.monotonic() - start
+
+    latencies = api.latencies()
+    print(f'推送 {args.updates} 条，收到 {replied} 条回复，用时 {elapsed:.2f} 秒')
+    print(f'延迟 p50 {percentile(latencies, 50) * 1000:.1f} ms，p99 {percentile(latencies, 99) * 1000:.1f} ms')
+    print('API 调用：' + ', '.join(f'{method} {count}' for method, count in sorted(api.calls.items())))
+
+
+if __name__ == '__main__':
+    main()
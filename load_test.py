@@ -0,0 +1,358 @@
+# 压力测试：本地启动假的 Telegram Bot API 和假的 Socket.IO 服务器，用生成的配置运行 main.py，
+# 回放各种事件（游戏聊天刷屏、大量玩家加入、集体死亡、群聊刷屏、/list 查询），统计吞吐量、延迟和 API 调用次数
+# 用法：
+#   python load_test.py --scenario mix --events 500 --rate 50
+#   python load_test.py --scenario death --latency 0.05 --rate-limit 0.05 --set coalesce='{"window": 0}'
+# 游戏 -> Telegram 的延迟按消息里的标记（LT000001）第一次出现在 sendMessage / editMessageText 里的时间计算
+# Telegram -> 游戏的延迟按 message_id 第一次出现在发给 Socket.IO 服务器的 chat 事件里的时间计算
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import socketio
+from aiohttp import web
+
+from fake_bot_api import FakeBotAPI, percentile
+
+GROUP_ID = -1001000000000
+ADMIN_ID = 1
+# 已绑定 MC 用户名的 Telegram 用户：tg id = 1000 + i，MC 用户名 Steve{i}
+BOUND_PLAYERS = 20
+marker_pattern = re.compile(r'LT\d{6}')
+scenarios = {
+    'chat': {'chat': 1},
+    'join': {'join': 1},
+    'death': {'death': 1},
+    'tg-chat': {'tg-chat': 1},
+    'list': {'list': 1},
+    'mix': {'chat': 4, 'join': 1, 'death': 1, 'tg-chat': 4, 'list': 1},
+}
+
+
+# 在 FakeBotAPI 的基础上记录每个标记第一次被机器人发出来的时间
+class LoadTestBotAPI(FakeBotAPI):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delivered = {}
+
+    def observe(self, text):
+        now = time.monotonic()
+        with self.lock:
+            for marker in marker_pattern.findall(text):
+                self.delivered.setdefault(marker, now)
+
+    def api_sendMessage(self, params):
+        self.observe(str(params.get('text', '')))
+        return super().api_sendMessage(params)
+
+    def api_editMessageText(self, params):
+        self.observe(str(params.get('text', '')))
+        return super().api_editMessageText(params)
+
+    def photo_update(self, chat_id, user_id, caption):
+        update = self.text_update(chat_id, user_id, '')
+        message = update['message']
+        del message['text']
+        file_id = f'photo{message["message_id"]}'
+        message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 720}]
+        message['caption'] = caption
+        return update
+
+
+# 假的 Minecraft 服务端：/status 和 /message 两个 namespace，在单独的线程里跑 aiohttp
+class FakeSocketServer:
+    def __init__(self, listen='127.0.0.1', port=8082):
+        self.listen = listen
+        self.port = port
+        self.sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins='*')
+        self.app = web.Application()
+        self.sio.attach(self.app)
+        self.loop = asyncio.new_event_loop()
+        self.lock = threading.Lock()
+        self.connected = set()
+        self.ready = threading.Event()
+        self.calls = Counter()
+        # 机器人发来的 chat 事件里的 Telegram message_id -> 收到的时间
+        self.received = {}
+        self.online = set()
+        for namespace in ('/status', '/message'):
+            self.sio.on('connect', self.on_connect(namespace), namespace=namespace)
+            self.sio.on('disconnect', self.on_disconnect(namespace), namespace=namespace)
+        self.sio.on('chat', self.on_chat, namespace='/message')
+        self.sio.on('players', self.on_players, namespace='/status')
+        self.sio.on('performance', self.on_performance, namespace='/status')
+
+    def on_connect(self, namespace):
+        async def handler(sid, environ):
+            with self.lock:
+                self.calls['connect ' + namespace] += 1
+                self.connected.add(namespace)
+                if len(self.connected) == 2:
+                    self.ready.set()
+
+        return handler
+
+    def on_disconnect(self, namespace):
+        async def handler(sid, *args):
+            with self.lock:
+                self.calls['disconnect ' + namespace] += 1
+                self.connected.discard(namespace)
+
+        return handler
+
+    async def on_chat(self, sid, data):
+        now = time.monotonic()
+        if isinstance(data, str):
+            data = json.loads(data)
+        with self.lock:
+            self.calls['chat'] += 1
+            self.received.setdefault(data['message']['id'], now)
+
+    # 在线玩家和性能查询直接通过 ack 返回
+    async def on_players(self, sid, *args):
+        with self.lock:
+            self.calls['players'] += 1
+            names = sorted(self.online)
+        return json.dumps({'players': [{'name': name} for name in names], 'current': len(names), 'maximum': 100})
+
+    async def on_performance(self, sid, *args):
+        with self.lock:
+            self.calls['performance'] += 1
+        return json.dumps({'tps': 20.0, 'mspt': 12.5})
+
+    async def _serve(self):
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        await web.TCPSite(runner, self.listen, self.port).start()
+
+    def start(self):
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._serve(), self.loop).result()
+
+    def emit(self, event, data, namespace='/message'):
+        if event == 'join':
+            with self.lock:
+                self.online.add(data['sender']['minecraft_name'])
+        elif event == 'quit':
+            with self.lock:
+                self.online.discard(data['sender']['minecraft_name'])
+        # 和真的服务端一样，发的是 json 字符串
+        asyncio.run_coroutine_threadsafe(self.sio.emit(event, json.dumps(data), namespace=namespace), self.loop)
+
+
+def player_event(player, content):
+    return {'sender': {'minecraft_name': player, 'minecraft_uuid': '', 'telegram_name': '', 'telegram_id': 0},
+            'message': {'id': 0, 'content': content}}
+
+
+# 按场景生成事件：(类型, 发送函数)，发送函数返回用来统计延迟的 key
+class Workload:
+    def __init__(self, api, server, weights, seed=0):
+        self.api = api
+        self.server = server
+        self.rng = random.Random(seed)
+        self.kinds = list(weights)
+        self.weights = [weights[kind] for kind in self.kinds]
+        self.count = 0
+        # 加入过还没离开的玩家，大量加入之后再让他们离开
+        self.joined = []
+
+    def marker(self):
+        self.count += 1
+        return f'LT{self.count:06d}'
+
+    def next(self):
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        return kind, getattr(self, 'send_' + kind.replace('-', '_'))
+
+    def send_chat(self):
+        marker = self.marker()
+        content = [{'type': 'text', 'id': None, 'content': f'{marker} 有人一起挖矿吗'}]
+        # 有时候 @ 一个 Telegram 用户，会触发 getChat
+        if self.rng.random() < 0.2:
+            content.append({'type': 'at', 'id': 1000 + self.rng.randrange(BOUND_PLAYERS * 2), 'content': ''})
+        self.server.emit('chat', player_event(f'Steve{self.rng.randrange(BOUND_PLAYERS * 2)}', content))
+        return marker
+
+    def send_join(self):
+        # 在线的人多了以后随机让一个人离开，只统计加入消息的延迟
+        if len(self.joined) > 50 and self.rng.random() < 0.3:
+            player = self.joined.pop(self.rng.randrange(len(self.joined)))
+            self.server.emit('quit', player_event(player, []))
+        marker = self.marker()
+        self.server.emit('join', player_event(marker, []))
+        self.joined.append(marker)
+        return marker
+
+    def send_death(self):
+        marker = self.marker()
+        killer = self.rng.choice(['entity.minecraft.zombie', 'entity.minecraft.creeper', f'Steve{self.rng.randrange(5)}'])
+        self.server.emit('death', player_event(marker, [
+            {'type': 'text', 'id': None, 'content': 'death.attack.player'},
+            {'type': 'text', 'id': None, 'content': marker},
+            {'type': 'text', 'id': None, 'content': killer},
+        ]))
+        return marker
+
+    def send_tg_chat(self):
+        user_id = 1000 + self.rng.randrange(BOUND_PLAYERS * 2)
+        roll = self.rng.random()
+        if roll < 0.15:
+            update = self.api.photo_update(GROUP_ID, user_id, '截图')
+        elif roll < 0.25 and user_id < 1000 + BOUND_PLAYERS:
+            # 已绑定的用户 /at，机器人回复之后 5 秒删除回复
+            update = self.api.text_update(GROUP_ID, user_id, f'/at Steve{self.rng.randrange(BOUND_PLAYERS)} 快上线')
+        else:
+            update = self.api.text_update(GROUP_ID, user_id, '今晚开黑 🥵' if roll > 0.95 else '今晚开黑')
+        self.api.push(update)
+        return update['message']['message_id']
+
+    def send_list(self):
+        # 每次从不同的私聊查询，避免被单个私聊的限速影响
+        user_id = 5000 + self.rng.randrange(1000000)
+        update = self.api.text_update(user_id, user_id, '/list')
+        self.api.push(update)
+        return update['message']['message_id']
+
+
+def write_config(folder, args):
+    config = {
+        'bot_token': '123456:load-test',
+        'group_id': str(GROUP_ID),
+        'proxy_enabled': False,
+        'proxy': '',
+        'bot_username': '@fake_bot',
+        'bot_name': 'bot',
+        # 没有监听的端口，/status 探测会立刻失败
+        'server_ip': '127.0.0.1',
+        'server_port': 1,
+        'server_ip_export': '127.0.0.1',
+        'server_name': 'load test',
+        'websocket_url': f'http://{args.listen}:{args.sio_port}',
+        'admin_id': str(ADMIN_ID),
+        'uptime': None,
+        'api_url': f'http://{args.listen}:{args.api_port}/bot{{0}}/{{1}}',
+        'runtime': args.runtime,
+    }
+    for item in args.set:
+        key, value = item.split('=', 1)
+        config[key] = json.loads(value)
+    with open(os.path.join(folder, 'config.json'), 'w', encoding='utf8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    os.makedirs(os.path.join(folder, 'data'))
+    with open(os.path.join(folder, 'data', 'id.json'), 'w', encoding='utf8') as f:
+        json.dump({str(1000 + i): f'Steve{i}' for i in range(BOUND_PLAYERS)}, f)
+    shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'res'), os.path.join(folder, 'res'))
+
+
+def report(title, latencies, sent):
+    print(f'{title:<10} 发送 {sent:>6}  送达 {len(latencies):>6}  '
+          f'p50 {percentile(latencies, 50) * 1000:>8.1f} ms  p99 {percentile(latencies, 99) * 1000:>8.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='机器人压力测试')
+    parser.add_argument('--scenario', choices=sorted(scenarios), default='mix')
+    parser.add_argument('--events', type=int, default=300, help='一共发送多少个事件')
+    parser.add_argument('--rate', type=float, default=50, help='每秒发送多少个事件')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个 Bot API 请求的额外延迟（秒）')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='Bot API 返回 429 的概率')
+    parser.add_argument('--runtime', choices=['threaded', 'asyncio'], default='threaded')
+    parser.add_argument('--listen', default='127.0.0.1')
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--sio-port', type=int, default=8082)
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=JSON',
+                        help='覆盖生成的 config.json 里的配置，例如 --set outbound=\'{"group_per_minute": 600}\'')
+    parser.add_argument('--drain', type=float, default=60, help='发送完之后最多等待多少秒')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='保留临时目录（配置、数据和日志）')
+    args = parser.parse_args()
+
+    api = LoadTestBotAPI(args.listen, args.api_port, args.latency, args.rate_limit)
+    server = FakeSocketServer(args.listen, args.sio_port)
+    api.start()
+    server.start()
+
+    folder = tempfile.mkdtemp(prefix='bot_load_test_')
+    write_config(folder, args)
+    log = open(os.path.join(folder, 'bot.log'), 'w')
+    bot = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')],
+                           cwd=folder, stdout=log, stderr=subprocess.STDOUT)
+    print(f'临时目录：{folder}')
+    try:
+        deadline = time.monotonic() + 60
+        while not (api.polling_ready.is_set() and server.ready.is_set()):
+            if bot.poll() is not None or time.monotonic() > deadline:
+                print(f'机器人没有连接，日志见 {folder}/bot.log')
+                args.keep = True
+                return
+            time.sleep(0.1)
+        print(f'机器人已连接（{args.runtime}），场景 {args.scenario}，{args.events} 个事件，每秒 {args.rate} 个')
+
+        workload = Workload(api, server, scenarios[args.scenario], args.seed)
+        # 类型 -> [(key, 发送时间)]
+        sent = {}
+        start = time.monotonic()
+        for i in range(args.events):
+            kind, send = workload.next()
+            at = time.monotonic()
+            sent.setdefault(kind, []).append((send(), at))
+            time.sleep(max(0.0, start + (i + 1) / args.rate - time.monotonic()))
+        send_elapsed = time.monotonic() - start
+
+        # 等到所有事件都送达，或者超时
+        def delivered_at(kind, key):
+            if kind in ('chat', 'join', 'death'):
+                return api.delivered.get(key)
+            if kind == 'tg-chat':
+                return server.received.get(key)
+            return api.replied.get(key)
+
+        deadline = time.monotonic() + args.drain
+        while time.monotonic() < deadline:
+            if all(delivered_at(kind, key) is not None for kind, items in sent.items() for key, at in items):
+                break
+            time.sleep(0.1)
+
+        print(f'发送用时 {send_elapsed:.2f} 秒')
+        last = start
+        total = 0
+        for kind, items in sorted(sent.items()):
+            latencies = []
+            for key, at in items:
+                done = delivered_at(kind, key)
+                if done is not None:
+                    latencies.append(done - at)
+                    last = max(last, done)
+            total += len(latencies)
+            report(kind, sorted(latencies), len(items))
+        elapsed = last - start
+        print(f'送达 {total}/{args.events}，用时 {elapsed:.2f} 秒，吞吐量 {total / max(elapsed, 1e-9):.1f} 个/秒')
+        print('Bot API 调用：' + ', '.join(f'{method} {count}' for method, count in sorted(api.calls.items())))
+        print('Socket.IO 事件：' + ', '.join(f'{event} {count}' for event, count in sorted(server.calls.items())))
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        log.close()
+        api.stop()
+        if args.keep:
+            print(f'日志见 {folder}/bot.log')
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
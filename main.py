@@ -1,13 +1,31 @@
-import copy
+import asyncio
+import atexit
+import functools
+import heapq
+import hmac
+import inspect
+import itertools
 import json
 import os
+import queue
+import random
 import re
+import secrets
+import signal
+import sqlite3
+import sys
 import threading
 import time
 import traceback
-from datetime import datetime
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from enum import Enum
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlparse
 
+import engineio
 import minestat
 import requests
 import socketio
@@ -30,13 +48,235 @@ create_file_if('data/id.json')
 create_file_if('data/username_id.json')
 create_file_if('data/death_all.json')
 create_file_if('data/death_daily.json')
+create_file_if('data/death_history.json')
+create_file_if('data/death_causes.json')
 
 logger.add("logs/app_{time}.log", rotation="00:00", retention="10 days",
            format="[{level}] {time:MM-DD HH:mm:ss.SSS} ({module}:{line}) - {message}")
 
 
+# 进程内的监控指标（计数器、仪表、直方图），以 Prometheus 文本格式导出
+class Metrics:
+    # 直方图的桶（秒）
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 名字 -> (类型, 说明)
+        self.meta = {}
+        # 名字 -> {标签: 值}
+        self.counters = {}
+        # 名字 -> {标签: [各个桶的计数, 总和, 总数]}
+        self.histograms = {}
+        # 名字 -> 采集时调用的函数，返回 {标签: 值}
+        self.gauges = {}
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def describe(self, name, metric_type, help_text):
+        self.meta[name] = (metric_type, help_text)
+
+    def inc(self, name, labels=None, value=1):
+        key = self._labels(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=None):
+        key = self._labels(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[0][i] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    @staticmethod
+    def _format_labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        # 标签值里的反斜杠、双引号和换行要转义
+        return '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                              for k, v in pairs) + '}'
+
+    def render(self):
+        lines = []
+
+        def header(name, default_type):
+            metric_type, help_text = self.meta.get(name, (default_type, ''))
+            if help_text:
+                lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {name: {key: (list(entry[0]), entry[1], entry[2]) for key, entry in series.items()}
+                          for name, series in self.histograms.items()}
+        for name, series in sorted(counters.items()):
+            header(name, 'counter')
+            for key, value in series.items():
+                lines.append(f'{name}{self._format_labels(key)} {value}')
+        for name, series in sorted(histograms.items()):
+            header(name, 'histogram')
+            for key, (bucket_counts, total, count) in series.items():
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f'{name}_bucket{self._format_labels(key, [("le", bound)])} {bucket_count}')
+                lines.append(f'{name}_bucket{self._format_labels(key, [("le", "+Inf")])} {count}')
+                lines.append(f'{name}_sum{self._format_labels(key)} {total}')
+                lines.append(f'{name}_count{self._format_labels(key)} {count}')
+        for name, func in sorted(self.gauges.items()):
+            try:
+                series = func()
+            except Exception as e:
+                logger.error({'指标采集失败', name, str(e)})
+                continue
+            header(name, 'gauge')
+            for labels, value in series.items():
+                lines.append(f'{name}{self._format_labels(self._labels(dict(labels)))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+# 记录处理函数里各个子调用（Bot API、读文件、socket.io 发送等）的耗时，用来分析慢的处理函数
+# 每个线程同时只有一个处理函数在执行，嵌套的子调用只算最外层的
+class HandlerTracer:
+    def __init__(self):
+        self.local = threading.local()
+
+    def begin(self):
+        previous = (getattr(self.local, 'breakdown', None), getattr(self.local, 'depth', 0))
+        self.local.breakdown = {}
+        self.local.depth = 0
+        return previous
+
+    def end(self, previous):
+        breakdown = self.local.breakdown
+        self.local.breakdown, self.local.depth = previous
+        return breakdown
+
+    def enter(self):
+        if getattr(self.local, 'breakdown', None) is None:
+            return False
+        self.local.depth += 1
+        return True
+
+    def exit(self, name, seconds):
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            entry = self.local.breakdown.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def add(self, name, seconds):
+        if self.enter():
+            self.exit(name, seconds)
+
+    def span(self, name):
+        return TraceSpan(self, name)
+
+    # 装饰器：把函数的耗时记到当前处理函数的子调用里
+    def traced(self, name):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+class TraceSpan:
+    __slots__ = ('tracer', 'name', 'start', 'active')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.active = self.tracer.enter()
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        if self.active:
+            self.tracer.exit(self.name, time.monotonic() - self.start)
+
+
+tracer = HandlerTracer()
+
+
+# 采样分析：定时抓取所有线程的调用栈，统计每个函数出现的次数
+# cProfile 只能分析开启它的那个线程，这里要看的是整个进程
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        # 函数 -> 在栈顶的次数 / 在栈里的次数
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+        self.thread_counts = Counter()
+        self.samples = 0
+
+    @staticmethod
+    def _function(frame):
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def sample(self):
+        current = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == current:
+                continue
+            self.thread_counts[names.get(ident, str(ident))] += 1
+            self.self_counts[self._function(frame)] += 1
+            seen = set()
+            while frame is not None:
+                function = self._function(frame)
+                # 递归的函数只算一次
+                if function not in seen:
+                    seen.add(function)
+                    self.total_counts[function] += 1
+                frame = frame.f_back
+        self.samples += 1
+
+    def run(self, seconds):
+        deadline = time.monotonic() + seconds
+        next_sample = time.monotonic()
+        while next_sample < deadline:
+            self.sample()
+            next_sample += self.interval
+            time.sleep(max(0.0, next_sample - time.monotonic()))
+
+    def report(self, top=50):
+        lines = [f'采样 {self.samples} 次，间隔 {self.interval * 1000:.0f} ms',
+                 '等待中的线程也会被采到，栈顶是 wait / select / recv 之类的一般是在空闲', '',
+                 '线程：']
+        lines += [f'{count:>8}  {name}' for name, count in self.thread_counts.most_common()]
+        for title, counts in (('栈顶（自身耗时）：', self.self_counts), ('栈中（累计耗时）：', self.total_counts)):
+            lines += ['', title]
+            lines += [f'{count:>8} {count * 100 / max(self.samples, 1):>7.1f}%  {function}'
+                      for function, count in counts.most_common(top)]
+        return '\n'.join(lines) + '\n'
+
+
 # 读取对应的json并且解析
+@tracer.traced('read_data')
 def read_data(file_type, folder='data'):
+    metrics.inc('store_reads_total', {'file': file_type})
     if folder == '':
         with open(f'{file_type}.json', encoding='utf8') as f:
             data = json.load(f)
@@ -46,10 +286,1666 @@ def read_data(file_type, folder='data'):
     return data
 
 
-# 将对应的json写入
-def write_data(file_type, data):
-    with open(f'data/{file_type}.json', 'w') as f:
-        f.write(json.dumps(data))
+# 常驻内存的json存储：修改后只标记为脏数据，由后台线程合并后写入
+# 写入时先写临时文件再重命名，进程中途被杀也不会留下写了一半的文件
+class JsonStore:
+    def __init__(self, folder, interval):
+        self.folder = folder
+        self.interval = interval
+        # 所有线程修改存储里的数据时都要持有这个锁
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.data = {}
+        self.dirty = set()
+        # 上次写入的内容，没有变化就不写
+        self.written = {}
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._flush_loop, name='json-store', daemon=True)
+        self.thread.start()
+
+    # 第一次使用时从硬盘读取，之后一直用内存里的
+    def load(self, file_type):
+        with self.lock:
+            if file_type not in self.data:
+                data = read_data(file_type, self.folder)
+                self.data[file_type] = data
+                self.written[file_type] = json.dumps(data)
+            return self.data[file_type]
+
+    def set(self, file_type, data):
+        with self.lock:
+            self.data[file_type] = data
+            self.mark_dirty(file_type)
+
+    def mark_dirty(self, file_type):
+        with self.lock:
+            self.dirty.add(file_type)
+        self.wakeup.set()
+
+    def flush(self):
+        with self.flush_lock:
+            # 在锁内序列化，保证写入的是一致的快照
+            with self.lock:
+                pending = {file_type: json.dumps(self.data[file_type]) for file_type in self.dirty}
+                self.dirty.clear()
+            for file_type, text in pending.items():
+                if self.written.get(file_type) == text:
+                    continue
+                self._write(file_type, text)
+                self.written[file_type] = text
+
+    def _write(self, file_type, text):
+        metrics.inc('store_writes_total', {'file': file_type})
+        path = f'{self.folder}/{file_type}.json'
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _flush_loop(self):
+        while not self.closed:
+            self.wakeup.wait()
+            # 等一会儿，把这段时间内的修改合并成一次写入
+            time.sleep(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(traceback.format_exc())
+
+    def close(self):
+        self.closed = True
+        self.flush()
+
+
+# 机器人实际用到的翻译命名空间，其余的不常驻内存
+translation_prefixes = ('death.', 'advancements.', 'chat.type.advancement.', 'entity.', 'item.')
+translation_format_pattern = re.compile(r'%(?:(\d+)\$)?s')
+
+
+# 预编译的翻译模板，把 %s / %1$s 拆成 文本 和 参数位置
+class TranslationTemplate:
+    __slots__ = ('parts',)
+
+    def __init__(self, text):
+        self.parts = []
+        last = 0
+        auto_index = 0
+        for match in translation_format_pattern.finditer(text):
+            self.parts.append(text[last:match.start()])
+            if match.group(1):
+                index = int(match.group(1)) - 1
+            else:
+                index = auto_index
+                auto_index += 1
+            self.parts.append((index, match.group(0)))
+            last = match.end()
+        self.parts.append(text[last:])
+
+    # 填充参数，没有给出（或为 None）的参数保留原占位符
+    def render(self, *args):
+        result = []
+        for part in self.parts:
+            if part.__class__ is str:
+                result.append(part)
+            else:
+                index, placeholder = part
+                if index < len(args) and args[index] is not None:
+                    result.append(args[index])
+                else:
+                    result.append(placeholder)
+        return ''.join(result)
+
+
+translations = None
+translation_templates = {}
+translations_lock = threading.Lock()
+
+
+# 第一次用到时读取res/zh_cn.json，只保留需要的部分并预编译模板
+def load_translations():
+    global translations
+    with translations_lock:
+        if translations is not None:
+            return translations
+        zh_cn_data = read_data('zh_cn', 'res')
+        table = {k: v for k, v in zh_cn_data.items() if k.startswith(translation_prefixes)}
+        for k, v in table.items():
+            if '%' in v:
+                translation_templates[k] = TranslationTemplate(v)
+        translations = table
+        logger.info(f'已加载 {len(table)} 条翻译')
+    return translations
+
+
+def has_translation(key):
+    return key in (translations or load_translations())
+
+
+# 找不到翻译时返回原key
+def translate(key):
+    return (translations or load_translations()).get(key, key)
+
+
+def get_template(key):
+    table = translations or load_translations()
+    template = translation_templates.get(key)
+    if template is None:
+        template = TranslationTemplate(table.get(key, key))
+    return template
+
+
+# json文件存储后端
+class JsonBackend:
+    def __init__(self, json_store):
+        self.store = json_store
+        self.lock = json_store.lock
+
+    def load_map(self, name):
+        return self.store.load(name)
+
+    def set_item(self, name, key, value):
+        with self.lock:
+            self.store.load(name)[key] = value
+            self.store.mark_dirty(name)
+
+    def delete_item(self, name, key):
+        with self.lock:
+            self.store.load(name).pop(key, None)
+            self.store.mark_dirty(name)
+
+    def record_death(self, player, day, cause=None):
+        with self.lock:
+            death_all_data = self.store.load('death_all')
+            death_all_data[player] = death_all_data.get(player, 0) + 1
+            self.store.mark_dirty('death_all')
+
+            # 判断是否为新的一天
+            death_daily_data = self.store.load('death_daily')
+            if death_daily_data.get('date') != day:
+                death_daily_data = {
+                    'date': day,
+                    'data': {}
+                }
+            death_daily_data['data'][player] = death_daily_data['data'].get(player, 0) + 1
+            self.store.set('death_daily', death_daily_data)
+
+            # 按天记录的历史
+            death_history_data = self.store.load('death_history')
+            day_data = death_history_data.setdefault(day, {})
+            day_data[player] = day_data.get(player, 0) + 1
+            self.store.mark_dirty('death_history')
+
+            if cause:
+                death_causes_data = self.store.load('death_causes')
+                player_causes = death_causes_data.setdefault(player, {})
+                player_causes[cause] = player_causes.get(cause, 0) + 1
+                self.store.mark_dirty('death_causes')
+
+    # 返回 (总数, {日期: {玩家: 次数}}, {玩家: {死因: 次数}})
+    def load_death_stats(self):
+        with self.lock:
+            days = {day: dict(day_data) for day, day_data in self.store.load('death_history').items()}
+            # 有历史记录之前只有当天的数据
+            death_daily_data = self.store.load('death_daily')
+            if death_daily_data.get('date') and death_daily_data['date'] not in days:
+                days[death_daily_data['date']] = dict(death_daily_data.get('data') or {})
+            causes = {player: dict(player_causes) for player, player_causes in
+                      self.store.load('death_causes').items()}
+            return dict(self.store.load('death_all')), days, causes
+
+    def close(self):
+        self.store.close()
+
+
+# SQLite 存储后端，绑定按 mc 用户名和 tg id 都建了索引
+# 使用 WAL 模式，每个线程用自己的连接读，写入时不会阻塞读取
+class SqliteBackend:
+    schema = '''
+    CREATE TABLE IF NOT EXISTS bindings (
+        tg_id TEXT PRIMARY KEY,
+        mc_name TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS bindings_mc_name ON bindings (mc_name);
+    CREATE TABLE IF NOT EXISTS usernames (
+        tg_id TEXT NOT NULL,
+        username TEXT NOT NULL,
+        first_seen REAL NOT NULL,
+        last_seen REAL NOT NULL,
+        PRIMARY KEY (tg_id, username)
+    );
+    CREATE INDEX IF NOT EXISTS usernames_username ON usernames (username);
+    CREATE TABLE IF NOT EXISTS deaths (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        player TEXT NOT NULL,
+        day TEXT,
+        cause TEXT,
+        time REAL
+    );
+    CREATE INDEX IF NOT EXISTS deaths_player ON deaths (player);
+    CREATE INDEX IF NOT EXISTS deaths_day ON deaths (day, player);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.writer = self._connect()
+        self.writer.execute('PRAGMA journal_mode=WAL')
+        self.writer.executescript(self.schema)
+        self.writer.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    # 读取用当前线程自己的连接
+    def _reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self.local.conn = conn
+        return conn
+
+    @tracer.traced('sqlite_write')
+    def _write(self, sql, params=()):
+        with self.lock:
+            with self.writer:
+                self.writer.execute(sql, params)
+
+    def load_map(self, name):
+        if name == 'id':
+            rows = self._reader().execute('SELECT tg_id, mc_name FROM bindings')
+        else:
+            # 用户名历史里每个id取最近一次见到的用户名
+            rows = self._reader().execute('SELECT tg_id, username FROM usernames ORDER BY last_seen')
+        return {tg_id: value for tg_id, value in rows}
+
+    def set_item(self, name, key, value):
+        if name == 'id':
+            self._write('INSERT OR REPLACE INTO bindings (tg_id, mc_name) VALUES (?, ?)', (key, value))
+        else:
+            now = time.time()
+            self._write('INSERT INTO usernames (tg_id, username, first_seen, last_seen) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (tg_id, username) DO UPDATE SET last_seen = excluded.last_seen',
+                        (key, value, now, now))
+
+    def delete_item(self, name, key):
+        if name == 'id':
+            self._write('DELETE FROM bindings WHERE tg_id = ?', (key,))
+        else:
+            self._write('DELETE FROM usernames WHERE tg_id = ?', (key,))
+
+    def record_death(self, player, day, cause=None):
+        self._write('INSERT INTO deaths (player, day, cause, time) VALUES (?, ?, ?, ?)',
+                    (player, day, cause, time.time()))
+
+    def death_totals(self):
+        rows = self._reader().execute('SELECT player, COUNT(*) FROM deaths GROUP BY player')
+        return dict(rows.fetchall())
+
+    def load_death_stats(self):
+        conn = self._reader()
+        days = {}
+        for day, player, count in conn.execute('SELECT day, player, COUNT(*) FROM deaths WHERE day IS NOT NULL '
+                                               'GROUP BY day, player'):
+            days.setdefault(day, {})[player] = count
+        causes = {}
+        for player, cause, count in conn.execute('SELECT player, cause, COUNT(*) FROM deaths WHERE cause IS NOT NULL '
+                                                 'GROUP BY player, cause'):
+            causes.setdefault(player, {})[cause] = count
+        return self.death_totals(), days, causes
+
+    # 一次性把原来 data/*.json 里的数据导入，导入过就不再导入
+    def migrate_from_json(self, folder='data'):
+        if self._reader().execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+        id_data = read_data('id', folder)
+        username_id_data = read_data('username_id', folder)
+        death_all_data = read_data('death_all', folder)
+        death_daily_data = read_data('death_daily', folder)
+        death_history_data = read_data('death_history', folder)
+        death_causes_data = read_data('death_causes', folder)
+        # 和 JsonBackend.load_death_stats 一样，有历史记录之前只有当天的数据
+        days = {day: dict(day_data) for day, day_data in death_history_data.items()}
+        if death_daily_data.get('date') and death_daily_data['date'] not in days:
+            days[death_daily_data['date']] = dict(death_daily_data.get('data') or {})
+        player_days = {}
+        for day, day_data in sorted(days.items()):
+            for player, count in day_data.items():
+                player_days.setdefault(player, []).extend([day] * count)
+        now = time.time()
+        death_rows = []
+        for player in set(death_all_data) | set(player_days) | set(death_causes_data):
+            dates = player_days.get(player, [])
+            causes = [cause for cause, count in (death_causes_data.get(player) or {}).items() for _ in range(count)]
+            # json 里日期和死因是分开统计的，不知道对应关系，按顺序配对；每天和每种死因的次数都不变
+            # 没有日期或死因的死亡记为空
+            count = max(death_all_data.get(player, 0), len(dates), len(causes))
+            dates += [None] * (count - len(dates))
+            causes += [None] * (count - len(causes))
+            death_rows += [(player, day, cause, 0) for day, cause in zip(dates, causes)]
+        with self.lock:
+            with self.writer:
+                self.writer.executemany('INSERT OR REPLACE INTO bindings (tg_id, mc_name) VALUES (?, ?)',
+                                        id_data.items())
+                self.writer.executemany('INSERT OR IGNORE INTO usernames (tg_id, username, first_seen, last_seen) '
+                                        'VALUES (?, ?, ?, ?)',
+                                        [(k, v, now, now) for k, v in username_id_data.items()])
+                self.writer.executemany('INSERT INTO deaths (player, day, cause, time) VALUES (?, ?, ?, ?)',
+                                        death_rows)
+                self.writer.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (str(now),))
+        logger.info(f'已从 json 导入 {len(id_data)} 个绑定、{len(username_id_data)} 个用户名、{len(death_rows)} 条死亡记录')
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+
+
+# 常驻内存的双向索引（id -> 值 与 值 -> id），加载一次，写入时持久化
+class IdentityIndex:
+    def __init__(self, storage_backend, name):
+        self.backend = storage_backend
+        self.name = name
+        self.lock = storage_backend.lock
+        self.forward = storage_backend.load_map(name)
+        # 每次修改都会 +1，用于判断缓存是否过期
+        self.version = 0
+        self.reverse = {}
+        for k, v in self.forward.items():
+            # 与原来的线性查找保持一致：同一个值对应多个id时取第一个
+            self.reverse.setdefault(v, k)
+
+    def get(self, key):
+        return self.forward.get(str(key))
+
+    def get_key(self, value):
+        return self.reverse.get(value)
+
+    def set(self, key, value):
+        key = str(key)
+        with self.lock:
+            old_value = self.forward.get(key)
+            if old_value == value:
+                return False
+            if old_value is not None:
+                self._drop_reverse(key, old_value)
+            self.forward[key] = value
+            self.reverse[value] = key
+            self.version += 1
+            self.backend.set_item(self.name, key, value)
+        return True
+
+    def remove(self, key):
+        key = str(key)
+        with self.lock:
+            if key not in self.forward:
+                return False
+            self._drop_reverse(key, self.forward.pop(key))
+            self.version += 1
+            self.backend.delete_item(self.name, key)
+        return True
+
+    def _drop_reverse(self, key, value):
+        if self.reverse.get(value) != key:
+            return
+        del self.reverse[value]
+        # 极少数情况下还有别的id对应同一个值，补回反向索引
+        for k, v in self.forward.items():
+            if v == value and k != key:
+                self.reverse[value] = k
+                break
+
+
+# bot.get_chat 结果缓存，有大小上限和过期时间，chat not found 也会缓存一段时间
+class ProfileCache:
+    def __init__(self, size, ttl, negative_ttl):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        # id -> (过期时间, 资料)，资料为 None 表示 chat not found
+        self.entries = OrderedDict()
+
+    # 返回 (是否命中, 资料)
+    def peek(self, user_id):
+        key = str(user_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    return True, entry[1]
+                del self.entries[key]
+        return False, None
+
+    def put(self, user_id, profile, negative=False):
+        expire = time.monotonic() + (self.negative_ttl if negative else self.ttl)
+        key = str(user_id)
+        with self.lock:
+            self.entries[key] = (expire, profile)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    # 获取失败时记录日志，chat not found 记为负缓存，网络错误之类的不缓存
+    def fetch_failed(self, user_id, e):
+        if str(e).find('chat not found') == -1:
+            logger.error(traceback.format_exc())
+            return
+        logger.error(e)
+        self.put(user_id, None, negative=True)
+
+    def get(self, user_id, fetch):
+        hit, profile = self.peek(user_id)
+        if hit:
+            return profile
+        try:
+            profile = fetch(user_id)
+        except Exception as e:
+            self.fetch_failed(user_id, e)
+            return None
+        self.put(user_id, profile)
+        return profile
+
+    async def aget(self, user_id, fetch):
+        hit, profile = self.peek(user_id)
+        if hit:
+            return profile
+        try:
+            profile = await fetch(user_id)
+        except Exception as e:
+            self.fetch_failed(user_id, e)
+            return None
+        self.put(user_id, profile)
+        return profile
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(str(user_id), None)
+
+
+# 一次 get_chat 同时生成带链接和不带格式的两种名字
+def profile_from_chat(userinfo):
+    # 判断是否有last_name
+    if userinfo.last_name:
+        noformat = f'{userinfo.first_name} {userinfo.last_name}'
+    else:
+        noformat = f'{userinfo.first_name}'
+    # 判断是否有tg昵称
+    if userinfo.username:
+        formatted = f'[{noformat}](t.me/{userinfo.username})'
+    else:
+        formatted = noformat
+    return {
+        'username': userinfo.username,
+        'first_name': userinfo.first_name,
+        'format': formatted or None,
+        'noformat': noformat or None,
+    }
+
+
+def fetch_tg_profile(user_id):
+    return profile_from_chat(bot.get_chat(user_id))
+
+
+# 当前是否在异步模式的事件循环线程里
+def in_event_loop():
+    if runtime_mode != 'asyncio':
+        return False
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+async def afetch_tg_profile(user_id):
+    return profile_from_chat(await abot.get_chat(user_id))
+
+
+def get_tg_profile(user_id):
+    if not user_id:
+        return None
+    if in_event_loop():
+        # 事件循环里不能阻塞，只用协程预取到缓存里的资料；处理函数在线程池里执行，没预取到会自己请求
+        return profile_cache.peek(user_id)[1]
+    return profile_cache.get(user_id, fetch_tg_profile)
+
+
+async def aget_tg_profile(user_id):
+    if not user_id:
+        return None
+    return await profile_cache.aget(user_id, afetch_tg_profile)
+
+
+# 按次数从大到小排好序的计数器，每次 +1 只需要交换一次位置，取前k名是 O(k)
+class RankedCounter:
+    def __init__(self, counts=None):
+        self.counts = {}
+        self.order = []
+        self.position = {}
+        # 次数 -> 这个次数在 order 里第一次出现的位置
+        self.run_start = {}
+        for key, count in sorted((counts or {}).items(), key=lambda x: x[1], reverse=True):
+            if count <= 0:
+                continue
+            self.counts[key] = count
+            self.position[key] = len(self.order)
+            self.run_start.setdefault(count, len(self.order))
+            self.order.append(key)
+
+    def incr(self, key):
+        count = self.counts.get(key, 0)
+        if count == 0:
+            self.counts[key] = 0
+            self.position[key] = len(self.order)
+            self.run_start.setdefault(0, len(self.order))
+            self.order.append(key)
+        # 和同样次数的第一个交换，然后次数 +1
+        pos = self.position[key]
+        start = self.run_start[count]
+        other = self.order[start]
+        self.order[start], self.order[pos] = key, other
+        self.position[key], self.position[other] = start, pos
+        if start + 1 < len(self.order) and self.counts[self.order[start + 1]] == count:
+            self.run_start[count] = start + 1
+        else:
+            del self.run_start[count]
+        self.counts[key] = count + 1
+        self.run_start.setdefault(count + 1, start)
+
+    def get(self, key):
+        return self.counts.get(key, 0)
+
+    # 并列的名次相同
+    def rank(self, key):
+        count = self.counts.get(key, 0)
+        if count == 0:
+            return None
+        return self.run_start[count] + 1
+
+    def top(self, k):
+        return [(key, self.counts[key]) for key in self.order[:k]]
+
+    def __len__(self):
+        return len(self.order)
+
+
+# 死亡统计：按天分桶，增量维护 今日/近7天/近30天/总榜 和每个玩家的死因
+class DeathStats:
+    windows = {'day': 1, 'week': 7, 'month': 30}
+
+    def __init__(self, storage_backend):
+        self.backend = storage_backend
+        self.lock = threading.RLock()
+        totals, days, causes = storage_backend.load_death_stats()
+        self.totals = RankedCounter(totals)
+        self.days = {day: Counter(day_data) for day, day_data in days.items()}
+        self.causes = {player: Counter(player_causes) for player, player_causes in causes.items()}
+        self.window_counters = {}
+        self.window_day = None
+        # 每次数据变化都会 +1，用于判断缓存是否过期
+        self.version = 0
+
+    @staticmethod
+    def today():
+        return datetime.now().strftime('%Y-%m-%d')
+
+    # 跨天时重新汇总各个窗口，一天只做一次
+    def _roll(self, today):
+        if self.window_day == today:
+            return
+        today_date = datetime.strptime(today, '%Y-%m-%d').date()
+        window_days = [(today_date - timedelta(days=i)).isoformat() for i in range(max(self.windows.values()))]
+        # 超出最大窗口的旧数据不再常驻内存（存储里仍然保留）
+        for day in list(self.days):
+            if day not in window_days:
+                del self.days[day]
+        for window, size in self.windows.items():
+            window_total = Counter()
+            for day in window_days[:size]:
+                window_total.update(self.days.get(day, {}))
+            self.window_counters[window] = RankedCounter(window_total)
+        self.window_day = today
+        self.version += 1
+
+    def record(self, player, cause=None):
+        today = self.today()
+        with self.lock:
+            self._roll(today)
+            self.days.setdefault(today, Counter())[player] += 1
+            self.totals.incr(player)
+            for window_counter in self.window_counters.values():
+                window_counter.incr(player)
+            if cause:
+                self.causes.setdefault(player, Counter())[cause] += 1
+            self.version += 1
+        self.backend.record_death(player, today, cause)
+
+    def counter(self, window):
+        with self.lock:
+            if window == 'all':
+                return self.totals
+            self._roll(self.today())
+            return self.window_counters[window]
+
+    def top(self, window, k=10):
+        with self.lock:
+            return self.counter(window).top(k)
+
+    def player(self, player):
+        with self.lock:
+            return {
+                'all': self.totals.get(player),
+                'rank': self.totals.rank(player),
+                'day': self.counter('day').get(player),
+                'week': self.counter('week').get(player),
+                'month': self.counter('month').get(player),
+                'causes': self.causes.get(player, Counter()).most_common(3),
+            }
+
+
+# 单线程的定时任务调度器（小顶堆）
+# 任务在调度线程里执行，必须很快返回，会阻塞的任务请放到 background_pool 里执行
+class Scheduler:
+    def __init__(self):
+        # 堆：(执行时间, 序号, 函数, 参数, 间隔)
+        self.queue = []
+        self.seq = itertools.count()
+        self.cancelled = set()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def _push(self, delay, func, args, interval):
+        with self.cond:
+            job_id = next(self.seq)
+            heapq.heappush(self.queue, (time.monotonic() + delay, job_id, func, args, interval))
+            self.cond.notify()
+        return job_id
+
+    # delay 秒后执行一次，返回的 id 可以用来取消
+    def call_later(self, delay, func, *args):
+        return self._push(delay, func, args, None)
+
+    # 每隔 interval 秒执行一次，第一次在 delay 秒后执行
+    def call_every(self, interval, func, *args, delay=None):
+        return self._push(interval if delay is None else delay, func, args, interval)
+
+    def cancel(self, job_id):
+        with self.cond:
+            self.cancelled.add(job_id)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue or self.queue[0][0] > time.monotonic():
+                    self.cond.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+                when, job_id, func, args, interval = heapq.heappop(self.queue)
+                if job_id in self.cancelled:
+                    self.cancelled.discard(job_id)
+                    continue
+                if interval is not None:
+                    # 周期任务用同一个 id 重新排队，落后太多时不补跑
+                    heapq.heappush(self.queue, (max(when + interval, time.monotonic()), job_id, func, args, interval))
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(traceback.format_exc())
+
+
+# 异步模式下的调度器，接口和 Scheduler 一样，任务在事件循环里执行
+class AsyncScheduler:
+    def __init__(self, event_loop):
+        self.loop = event_loop
+        self.seq = itertools.count()
+        self.handles = {}
+
+    def call_later(self, delay, func, *args):
+        job_id = next(self.seq)
+        self.loop.call_soon_threadsafe(self._schedule, job_id, delay, func, args, None)
+        return job_id
+
+    def call_every(self, interval, func, *args, delay=None):
+        job_id = next(self.seq)
+        self.loop.call_soon_threadsafe(self._schedule, job_id, interval if delay is None else delay, func, args,
+                                       interval)
+        return job_id
+
+    def cancel(self, job_id):
+        self.loop.call_soon_threadsafe(self._cancel, job_id)
+
+    def _schedule(self, job_id, delay, func, args, interval):
+        self.handles[job_id] = self.loop.call_later(delay, self._fire, job_id, func, args, interval)
+
+    def _cancel(self, job_id):
+        handle = self.handles.pop(job_id, None)
+        if handle:
+            handle.cancel()
+
+    def _fire(self, job_id, func, args, interval):
+        if interval is not None:
+            self._schedule(job_id, interval, func, args, interval)
+        else:
+            self.handles.pop(job_id, None)
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+
+
+# 发送优先级，数字越小越先发送
+PRIORITY_REPLY = 0  # 回复用户的命令
+PRIORITY_CHAT = 1  # 聊天消息转发
+PRIORITY_BULK = 2  # 加入、离开、死亡、成就等批量通知
+
+
+# 令牌桶限速
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # 收到 429 后在这个时间之前都不能发送
+        self.blocked_until = 0
+
+    # 还要等多少秒才有令牌
+    def wait_time(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundJob:
+    __slots__ = ('chat_id', 'method', 'args', 'kwargs', 'callback', 'tries')
+
+    def __init__(self, chat_id, method, args, kwargs, callback):
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.tries = 0
+
+
+# 统一的 Telegram 发送队列：所有发送都在这一个线程里按优先级、按频率限制发出
+# 处理函数只需要放进队列（传 bot 的方法名）就可以返回，遇到 429 会按 retry_after 等待后重试
+class OutboundDispatcher:
+    def __init__(self, telegram_bot, group_per_minute, private_per_second, global_per_second, max_retries):
+        self.bot = telegram_bot
+        self.group_per_minute = group_per_minute
+        self.private_per_second = private_per_second
+        self.global_bucket = TokenBucket(global_per_second, global_per_second)
+        self.max_retries = max_retries
+        self.buckets = {}
+        # 堆：(优先级, 序号, 任务)
+        self.queue = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        # 正在发送的聊天，同一个聊天同一时间只发一条，保证顺序
+        self.busy_chats = set()
+        # 发送成功后的回调放到线程池里执行，不阻塞发送线程
+        self.callback_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='outbound-callback')
+
+    # 启动之前放进队列的任务会在启动后发出
+    def start(self):
+        threading.Thread(target=self._run, name='outbound', daemon=True).start()
+
+    def submit(self, priority, chat_id, method, *args, callback=None, **kwargs):
+        # 回复传的是 int 的 chat.id，通知传的是配置里字符串的 id，统一成字符串，同一个聊天只有一个限速桶
+        if chat_id is not None:
+            chat_id = str(chat_id)
+        with self.cond:
+            heapq.heappush(self.queue, (priority, next(self.seq), OutboundJob(chat_id, method, args, kwargs, callback)))
+            self.cond.notify()
+
+    def qsize(self):
+        return len(self.queue)
+
+    def _bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            # 群组的 id 是负数
+            if str(chat_id).startswith('-'):
+                bucket = TokenBucket(self.group_per_minute / 60, max(1, self.group_per_minute // 4))
+            else:
+                bucket = TokenBucket(self.private_per_second, 1)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def _wait_time(self, job):
+        if job.chat_id in self.busy_chats:
+            return float('inf')
+        bucket = self._bucket(job.chat_id)
+        return max(self.global_bucket.wait_time(), bucket.wait_time() if bucket else 0)
+
+    # 取出最优先的可以发送的任务，都不能发送则返回需要等待的时间
+    def _next_job(self):
+        entry = self.queue[0]
+        wait = self._wait_time(entry[2])
+        if wait > 0:
+            # 队头被限速时，看看有没有其他聊天的任务可以先发
+            ready = [e for e in self.queue if self._wait_time(e[2]) == 0]
+            if not ready:
+                return None, wait
+            entry = min(ready)
+        self.queue.remove(entry)
+        heapq.heapify(self.queue)
+        self.global_bucket.take()
+        bucket = self._bucket(entry[2].chat_id)
+        if bucket:
+            bucket.take()
+        return entry, 0
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                entry, wait = self._next_job()
+                if entry is None:
+                    # 等待期间来了新任务会被唤醒重新选择
+                    self.cond.wait(wait)
+                    continue
+            self._execute(entry)
+
+    def _execute(self, entry):
+        job = entry[2]
+        job.tries += 1
+        try:
+            result = getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        except Exception as e:
+            self._failed(entry, e)
+            return
+        self._succeeded(job, result)
+
+    def _succeeded(self, job, result):
+        if job.callback:
+            self.callback_pool.submit(self._run_callback, job.callback, result)
+
+    def _failed(self, entry, e):
+        job = entry[2]
+        error_code = getattr(e, 'error_code', None)
+        if error_code == 429 and job.tries <= self.max_retries:
+            retry_after = ((getattr(e, 'result_json', None) or {}).get('parameters') or {}).get('retry_after', 5)
+            logger.warning({'telegram 限速', job.chat_id, retry_after})
+            self._retry(entry, retry_after)
+        elif error_code is None and job.tries <= self.max_retries:
+            # 网络错误之类的稍后重试
+            logger.warning({'telegram 发送失败，稍后重试', job.chat_id, str(e)})
+            self._retry(entry, job.tries)
+        else:
+            logger.error(traceback.format_exc())
+
+    def _retry(self, entry, delay):
+        with self.cond:
+            (self._bucket(entry[2].chat_id) or self.global_bucket).blocked_until = time.monotonic() + delay
+            # 保持原来的顺序重新排队
+            heapq.heappush(self.queue, entry)
+            self.cond.notify()
+
+    @staticmethod
+    def _run_callback(callback, result):
+        try:
+            callback(result)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+
+
+# 异步模式下的发送队列：在事件循环里发送，不同聊天的消息可以同时发送，同一个聊天按顺序发送
+class AsyncOutboundDispatcher(OutboundDispatcher):
+    def __init__(self, telegram_bot, event_loop, *args, max_in_flight=8):
+        super().__init__(telegram_bot, *args)
+        self.loop = event_loop
+        self.wakeup = asyncio.Event()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    def start(self):
+        self.loop.create_task(self._run())
+
+    def submit(self, priority, chat_id, method, *args, callback=None, **kwargs):
+        super().submit(priority, chat_id, method, *args, callback=callback, **kwargs)
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def _retry(self, entry, delay):
+        super()._retry(entry, delay)
+        self.wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self.in_flight.acquire()
+            self.wakeup.clear()
+            with self.cond:
+                entry, wait = self._next_job() if self.queue else (None, None)
+                if entry:
+                    self.busy_chats.add(entry[2].chat_id)
+            if entry is None:
+                self.in_flight.release()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), None if wait in (None, float('inf')) else wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.loop.create_task(self._execute(entry))
+
+    async def _execute(self, entry):
+        job = entry[2]
+        job.tries += 1
+        try:
+            result = await getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        except Exception as e:
+            self._failed(entry, e)
+        else:
+            self._succeeded(job, result)
+        finally:
+            with self.cond:
+                self.busy_chats.discard(job.chat_id)
+            self.in_flight.release()
+            self.wakeup.set()
+
+
+# 把短时间内的同类事件合并成一条群消息
+# 加入/离开合并成 "A, B, C 加入了服务器"，死亡和成就按行合并
+# 普通聊天合并后，如果上一条转发的聊天消息还比较新并且后面没有别的消息，就直接编辑追加到那条消息
+# 合并后超过 max_length 的分成几条发送
+class EventCoalescer:
+    formats = {
+        'join': lambda items: ', '.join(items) + ' 加入了服务器',
+        'quit': lambda items: ', '.join(items) + ' 离开了服务器',
+        'notice': lambda items: '\n'.join(items),
+    }
+
+    def __init__(self, window, edit_window, max_length=4000):
+        self.window = window
+        self.edit_window = edit_window
+        self.max_length = max_length
+        self.lock = threading.Lock()
+        self.pending = {}
+        # 上一条转发的聊天消息 {'id', 'text', 'time'}，中间插入了别的消息就清空
+        self.last_chat = None
+        self.generation = 0
+
+    def add(self, kind, item):
+        if self.window <= 0:
+            self.flush(kind, [item])
+            return
+        with self.lock:
+            batch = self.pending.get(kind)
+            if batch is None:
+                batch = self.pending[kind] = []
+                scheduler.call_later(self.window, self.flush, kind)
+            batch.append(item)
+
+    # 群里出现了别的消息，之后的聊天不能再追加到上一条
+    def interrupt(self):
+        with self.lock:
+            self.last_chat = None
+            self.generation += 1
+
+    def flush(self, kind, items=None):
+        if items is None:
+            with self.lock:
+                items = self.pending.pop(kind, [])
+        for batch in self.split(kind, items):
+            if kind == 'chat':
+                self._flush_chat('\n'.join(batch))
+            else:
+                send_message(self.formats[kind](batch))
+
+    # 按顺序把 items 分成几批，每批合并后不超过 max_length，本身就超长的一条单独一批
+    def split(self, kind, items):
+        format_items = self.formats.get(kind, '\n'.join)
+        # 合并后的长度 = 固定部分 + 每条的长度 + 分隔符
+        overhead = len(format_items(['']))
+        separator = len(format_items(['', ''])) - overhead
+        batch = []
+        length = overhead
+        for item in items:
+            added = len(item) + (separator if batch else 0)
+            if batch and length + added > self.max_length:
+                yield batch
+                batch = []
+                length = overhead
+                added = len(item)
+            batch.append(item)
+            length += added
+        if batch:
+            yield batch
+
+    def _flush_chat(self, text):
+        with self.lock:
+            last_chat = self.last_chat
+            # window 为 0 时不合并，也不追加
+            if last_chat and self.window > 0 and self.edit_window > 0 \
+                    and time.monotonic() - last_chat['time'] < self.edit_window \
+                    and len(last_chat['text']) + len(text) + 1 <= self.max_length:
+                last_chat['text'] += '\n' + text
+                new_text = last_chat['text']
+            else:
+                last_chat = None
+            generation = self.generation
+        logger.info({'tg 发送消息', text})
+        if last_chat:
+            outbound.submit(PRIORITY_CHAT, group_id, 'edit_message_text', new_text, group_id, last_chat['id'],
+                            disable_web_page_preview=True)
+        else:
+            outbound.submit(PRIORITY_CHAT, group_id, 'send_message', group_id, text, disable_web_page_preview=True,
+                            callback=lambda sent_message: self._remember_chat(sent_message, text, generation))
+
+    def _remember_chat(self, sent_message, text, generation):
+        with self.lock:
+            # 发送期间群里有了别的消息就不记录
+            if generation == self.generation:
+                self.last_chat = {'id': sent_message.message_id, 'text': text, 'time': time.monotonic()}
+
+
+# 服务器状态（MineStat）缓存，后台定时刷新
+# 同一时间最多只有一个探测在进行，同时发起的刷新共用这一个探测的结果
+class StatusPoller:
+    def __init__(self, probe, max_age):
+        self.probe = probe
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.result = None
+        self.updated = None
+        # 探测进行中时是等结果的回调列表，否则是 None
+        self.waiting = None
+
+    def start(self, interval):
+        scheduler.call_every(interval, self.refresh, delay=0)
+
+    # 发起一次刷新，已经有探测在进行就等它的结果，探测完成后调用 callback(结果, 距离上次更新的秒数)
+    def refresh(self, callback=None):
+        with self.lock:
+            start = self.waiting is None
+            if start:
+                self.waiting = []
+            if callback:
+                self.waiting.append(callback)
+        if start:
+            background_pool.submit(self._run)
+
+    def _run(self):
+        try:
+            result = self.probe()
+        except Exception as e:
+            logger.error({'服务器状态获取失败', str(e)})
+            result = None
+        with self.lock:
+            if result is not None:
+                self.result = result
+                self.updated = time.monotonic()
+            waiting = self.waiting
+            self.waiting = None
+        for callback in waiting:
+            try:
+                callback(self.result, self.age())
+            except Exception as e:
+                logger.error(traceback.format_exc())
+
+    def age(self):
+        if self.updated is None:
+            return None
+        return time.monotonic() - self.updated
+
+    # 调用 callback(结果, 距离上次更新的秒数)，结果够新就直接调用，否则刷新完成后在 background_pool 里调用，不会阻塞
+    def get(self, callback):
+        age = self.age()
+        if age is None or age > self.max_age:
+            self.refresh(callback)
+        else:
+            callback(self.result, age)
+
+
+# 在线玩家名单，由 join/quit 事件维护，定时用 players 事件校正
+# 断线期间可能漏掉事件，断线后名单标记为未同步，等下一次 players 事件
+class OnlineRoster:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 玩家名 -> 上线时间
+        self.players = {}
+        # 玩家名 -> 最后一次在线的时间
+        self.last_seen = {}
+        self.maximum = None
+        self.synced = False
+
+    def join(self, name):
+        with self.lock:
+            self.players.setdefault(name, time.time())
+
+    def quit(self, name):
+        with self.lock:
+            self.players.pop(name, None)
+            self.last_seen[name] = time.time()
+
+    def unsync(self):
+        with self.lock:
+            self.synced = False
+
+    def reconcile(self, names, maximum):
+        now = time.time()
+        with self.lock:
+            added_local, removed_local = compare_arrays(self.players, names)
+            if self.synced and (added_local or removed_local):
+                logger.info({'在线名单校正', str(added_local), str(removed_local)})
+            for name in added_local:
+                self.players[name] = now
+            for name in removed_local:
+                del self.players[name]
+                self.last_seen[name] = now
+            self.maximum = maximum
+            self.synced = True
+
+    # 没同步过返回 None
+    def snapshot(self):
+        with self.lock:
+            if not self.synced:
+                return None
+            return sorted(self.players, key=str.lower), self.maximum
+
+    # 最近 seconds 秒内在线过的玩家（包括现在在线的）
+    def recent(self, seconds):
+        now = time.time()
+        with self.lock:
+            for name, last in list(self.last_seen.items()):
+                if now - last > seconds:
+                    del self.last_seen[name]
+            return sorted(set(self.players) | set(self.last_seen), key=str.lower)
+
+
+# 向服务器查询状态（players、performance），把查询和回复对应起来
+# 查询进行中时同样的查询不会再发给服务器，结果出来后每个聊天只回复一次（回复最后一个提问的消息）
+# 短时间内的结果直接复用，已经回复过这个结果的聊天不再重复回复；服务器支持 ack 时用 ack 的数据，否则等广播回来的事件
+class StatusQuery:
+    def __init__(self, event, handle, timeout=10, reuse=3):
+        self.event = event
+        # 把服务器返回的数据变成回复文本
+        self.handle = handle
+        self.timeout = timeout
+        self.reuse = reuse
+        self.lock = threading.Lock()
+        self.waiting = []
+        self.timer = None
+        # (时间, 回复文本)
+        self.last = None
+        # 已经回复过 last 的聊天 id
+        self.replied = set()
+
+    def request(self, message_local):
+        text = None
+        with self.lock:
+            if self.last and time.monotonic() - self.last[0] < self.reuse:
+                if message_local.chat.id in self.replied:
+                    return
+                self.replied.add(message_local.chat.id)
+                text = self.last[1]
+            else:
+                self.waiting.append(message_local)
+                first = len(self.waiting) == 1
+                if first:
+                    self.timer = scheduler.call_later(self.timeout, self.expire)
+        if text is not None:
+            reply_to(message_local, text)
+        elif first:
+            emit(self.event, namespace='/status', callback=self.on_ack)
+
+    def on_ack(self, *args):
+        if args and args[0]:
+            self.resolve(args[0])
+
+    # 收到结果，回复在等的消息，返回回复了几条
+    def resolve(self, data):
+        text = self.handle(data)
+        with self.lock:
+            waiting = self.latest_per_chat()
+            timer = self.timer
+            self.timer = None
+            self.last = (time.monotonic(), text)
+            self.replied = set(waiting)
+        if timer is not None:
+            scheduler.cancel(timer)
+        for message_local in waiting.values():
+            reply_to(message_local, text)
+        return len(waiting)
+
+    def expire(self):
+        with self.lock:
+            waiting = self.latest_per_chat()
+            self.timer = None
+        for message_local in waiting.values():
+            reply_to(message_local, '服务器没有响应，请稍后再试')
+
+    # 取出在等的消息，同一个聊天只留最后一条，需要拿着 lock 调用
+    def latest_per_chat(self):
+        waiting = {message_local.chat.id: message_local for message_local in self.waiting}
+        self.waiting = []
+        return waiting
+
+
+# 图片 file_unique_id -> file_path 缓存，过期时间和 Telegram 下载链接的有效期一样（1 小时）
+# bot.get_file 在 media_pool 里执行，同一个文件同时只请求一次
+class FilePathCache:
+    def __init__(self, ttl=3600, size=1024):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        # file_unique_id -> (file_path, 过期时间)
+        self.paths = OrderedDict()
+        # 正在获取的 file_unique_id -> 获取到之后要调用的函数
+        self.pending = {}
+
+    def get(self, unique_id):
+        with self.lock:
+            entry = self.paths.get(unique_id)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self.paths[unique_id]
+                return None
+            self.paths.move_to_end(unique_id)
+            return entry[0]
+
+    # 后台获取路径，获取到之后调用 callback(file_path)，不传 callback 就是预取
+    def resolve(self, file_id, unique_id, callback=None):
+        file_path = self.get(unique_id)
+        if file_path:
+            if callback:
+                callback(file_path)
+            return
+        with self.lock:
+            callbacks = self.pending.get(unique_id)
+            if callbacks is not None:
+                if callback:
+                    callbacks.append(callback)
+                return
+            self.pending[unique_id] = [callback] if callback else []
+        media_pool.submit(self._fetch, file_id, unique_id)
+
+    def _fetch(self, file_id, unique_id):
+        try:
+            file_path = bot.get_file(file_id).file_path
+        except Exception as e:
+            logger.error({'获取文件路径失败', file_id, str(e)})
+            file_path = None
+        with self.lock:
+            callbacks = self.pending.pop(unique_id, [])
+            if file_path:
+                self.paths[unique_id] = (file_path, time.monotonic() + self.ttl)
+                self.paths.move_to_end(unique_id)
+                while len(self.paths) > self.size:
+                    self.paths.popitem(last=False)
+        if file_path:
+            for callback in callbacks:
+                try:
+                    callback(file_path)
+                except Exception as e:
+                    logger.error(traceback.format_exc())
+
+
+# 多线程执行任务，同一个 key 的任务严格按提交顺序一个接一个执行，不同 key 之间并行
+# 排队的任务总数有上限，满了 submit 会阻塞，让上游（轮询、webhook、socket.io 读取线程）慢下来
+class KeyedExecutor:
+    def __init__(self, workers, queue_size, name='keyed'):
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(queue_size)
+        # key -> 等待执行的任务
+        self.pending = {}
+        # 有任务等待执行、并且没有线程在执行的 key
+        self.ready = queue.Queue()
+        # 没有 key 的任务用一个不会重复的 key，不保证顺序
+        self.seq = itertools.count()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f'{name}-{i}', daemon=True).start()
+
+    def submit(self, key, func, *args, **kwargs):
+        if key is None:
+            key = ('unordered', next(self.seq))
+        self.slots.acquire()
+        with self.lock:
+            tasks = self.pending.get(key)
+            if tasks is None:
+                # 这个 key 没有线程在执行，交给空闲的线程
+                self.pending[key] = deque([(func, args, kwargs)])
+                self.ready.put(key)
+            else:
+                tasks.append((func, args, kwargs))
+
+    def _work(self):
+        while True:
+            key = self.ready.get()
+            with self.lock:
+                func, args, kwargs = self.pending[key][0]
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.error(traceback.format_exc())
+            self.slots.release()
+            with self.lock:
+                tasks = self.pending[key]
+                tasks.popleft()
+                if tasks:
+                    self.ready.put(key)
+                else:
+                    del self.pending[key]
+
+
+# 处理函数按聊天 id 分组交给 KeyedExecutor，同一个聊天的消息按顺序处理
+class OrderedTeleBot(telebot.TeleBot):
+    def __init__(self, *args, executor, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = executor
+
+    def _exec_task(self, task, *args, **kwargs):
+        update = args[0] if args else None
+        chat = getattr(update, 'chat', None) or getattr(getattr(update, 'message', None), 'chat', None)
+        self.executor.submit(('telegram', chat.id) if chat else None, task, *args, **kwargs)
+
+
+# engineio 默认每条消息开一个新线程处理，顺序没有保证
+# 这里改成在读取线程里按顺序分发，socket.io 的处理函数再按 namespace 交给 KeyedExecutor
+class OrderedEngineIOClient(engineio.Client):
+    def _trigger_event(self, event, *args, **kwargs):
+        if event == 'message':
+            kwargs['run_async'] = False
+        return super()._trigger_event(event, *args, **kwargs)
+
+
+class OrderedSocketIOClient(socketio.Client):
+    def _engineio_client_class(self):
+        return OrderedEngineIOClient
+
+
+# 处理函数接受几个参数，disconnect 之类的事件会多传参数，None 表示不限
+def handler_arg_count(handler):
+    parameters = inspect.signature(handler).parameters.values()
+    if any(parameter.kind == parameter.VAR_POSITIONAL for parameter in parameters):
+        return None
+    return len(parameters)
+
+
+# socket.io 连接管理：断线后按指数退避（带随机抖动）重连
+# 断线期间要发给服务器的聊天消息先放进有上限的缓冲区，两个 namespace 都连上后按顺序补发，满了丢弃最早的并计数
+class ConnectionSupervisor:
+    def __init__(self, namespaces, connect, disconnect, send, alive, min_delay=1, max_delay=300, buffer_size=200,
+                 connect_timeout=30):
+        self.namespaces = set(namespaces)
+        self.connected_namespaces = set()
+        # 连接一次，失败抛异常（会阻塞，在 background_pool 里执行）
+        self.connect = connect
+        self.disconnect = disconnect
+        # send(event, data, namespace)
+        self.send_func = send
+        # 底层连接是否还连着（namespace 可能还没全部连上）
+        self.alive = alive
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.buffer_size = buffer_size
+        # connect 返回之后等所有 namespace 连上的最长秒数，超时再重连
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        # 补发和直接发送都拿着这个锁，保证顺序
+        self.send_lock = threading.Lock()
+        self.buffer = deque()
+        self.dropped = 0
+        # 连续失败次数
+        self.failures = 0
+        # 已经安排了重连（或者正在连接、等待 namespace 连上）
+        self.pending = False
+        # 第几次连接，用来认出过期的超时检查
+        self.attempts = 0
+
+    def connected(self):
+        with self.lock:
+            return self.connected_namespaces == self.namespaces
+
+    def start(self):
+        self._schedule(0)
+
+    # 需要连接的时候调用，已经连上、底层连接还在或者已经安排了重连就什么都不做
+    def wake(self):
+        if not self.connected() and not self.alive():
+            self._schedule(0)
+
+    def _schedule(self, delay):
+        with self.lock:
+            if self.pending:
+                return
+            self.pending = True
+        scheduler.call_later(delay, background_pool.submit, self._attempt)
+
+    def _attempt(self):
+        # 主动断开触发的 disconnect 事件不用再安排重连
+        with self.lock:
+            self.connected_namespaces.clear()
+            self.attempts += 1
+            attempt = self.attempts
+        try:
+            # 清掉只连上一部分的状态
+            self.disconnect()
+            logger.info('连接 websocket')
+            self.connect()
+        except Exception as e:
+            with self.lock:
+                self.failures += 1
+                self.pending = False
+                first = self.failures == 1
+                delay = min(self.max_delay, self.min_delay * 2 ** (self.failures - 1))
+            delay = random.uniform(delay / 2, delay)
+            logger.error({'websocket 连接失败', str(e), f'{delay:.1f} 秒后重试'})
+            # 重连会一直重试，只在连续失败的第一次通知管理员
+            if first:
+                send_admin('socket 连接失败\n```\n' + str(e) + '\n```')
+            self._schedule(delay)
+        else:
+            # namespace 的连接事件可能在 connect 返回之后才到，pending 保持到 up 或者超时，期间不会再次连接
+            scheduler.call_later(self.connect_timeout, self._check, attempt)
+
+    # 连接之后超时还没有全部连上，断开重连
+    def _check(self, attempt):
+        with self.lock:
+            if attempt != self.attempts or not self.pending:
+                return
+            self.pending = False
+            missing = self.namespaces - self.connected_namespaces
+        logger.error({'websocket namespace 连接超时', ', '.join(sorted(missing))})
+        self._schedule(0)
+
+    # 返回是否所有 namespace 都已连接
+    def up(self, namespace):
+        with self.lock:
+            self.connected_namespaces.add(namespace)
+            ready = self.connected_namespaces == self.namespaces
+            if ready:
+                self.failures = 0
+                self.pending = False
+        if ready:
+            self.flush()
+        return ready
+
+    def down(self, namespace):
+        with self.lock:
+            if namespace not in self.connected_namespaces:
+                return
+            self.connected_namespaces.discard(namespace)
+            delay = self.min_delay
+        self._schedule(random.uniform(delay / 2, delay))
+
+    # 连着并且没有待补发的消息就直接发，否则放进缓冲区，返回是否直接发出
+    def send(self, event, data, namespace):
+        with self.lock:
+            direct = self.connected_namespaces == self.namespaces and not self.buffer
+            if not direct:
+                if len(self.buffer) >= self.buffer_size:
+                    self.buffer.popleft()
+                    self.dropped += 1
+                self.buffer.append((event, data, namespace))
+        if not direct:
+            self.wake()
+            return False
+        with self.send_lock:
+            try:
+                self.send_func(event, data, namespace)
+            except Exception as e:
+                # 刚好断开了，放回缓冲区等重连
+                logger.error({'websocket 发送失败', str(e)})
+                with self.lock:
+                    self.buffer.appendleft((event, data, namespace))
+                return False
+        return True
+
+    def flush(self):
+        replayed = 0
+        with self.send_lock:
+            while True:
+                with self.lock:
+                    if not self.buffer or self.connected_namespaces != self.namespaces:
+                        break
+                    item = self.buffer.popleft()
+                try:
+                    self.send_func(*item)
+                except Exception as e:
+                    logger.error({'websocket 补发失败', str(e)})
+                    with self.lock:
+                        self.buffer.appendleft(item)
+                    break
+                replayed += 1
+            with self.lock:
+                dropped = self.dropped
+                self.dropped = 0
+        if replayed:
+            logger.info(f'websocket 补发了 {replayed} 条消息')
+        if dropped:
+            logger.warning(f'websocket 断开期间缓冲区已满，丢弃了 {dropped} 条消息')
+            send_admin(f'socket 断开期间缓冲区已满，丢弃了 {dropped} 条消息')
+
+
+# webhook 模式下接收 Telegram 推送的更新
+# 校验 secret token 之后放进有上限的队列，由固定数量的线程处理；队列满了返回 503，Telegram 会稍后重发
+class WebhookServer:
+    def __init__(self, listen, port, path, secret_token, process, workers=4, queue_size=100):
+        if not secret_token:
+            raise ValueError('webhook 必须设置 secret_token')
+        self.path = path
+        self.secret_token = secret_token
+        # 处理一批更新的函数
+        self.process = process
+        self.workers = workers
+        self.queue = queue.Queue(queue_size)
+        webhook_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.send_response(webhook_server.accept(self))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((listen, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f'webhook-{i}', daemon=True).start()
+        threading.Thread(target=self.httpd.serve_forever, name='webhook').start()
+
+    # 返回 HTTP 状态码
+    def accept(self, request):
+        if request.path != self.path:
+            return 404
+        if not hmac.compare_digest(request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), self.secret_token):
+            return 403
+        # 空的或者解析不了的请求体返回 400
+        try:
+            body = request.rfile.read(int(request.headers.get('Content-Length', 0)))
+            update = telebot.types.Update.de_json(body.decode('utf-8'))
+        except Exception as e:
+            return 400
+        if update is None:
+            return 400
+        try:
+            self.queue.put_nowait(update)
+        except queue.Full:
+            logger.warning('webhook 队列已满')
+            return 503
+        return 200
+
+    def _work(self):
+        while True:
+            update = self.queue.get()
+            try:
+                self.process([update])
+            except Exception as e:
+                logger.error(traceback.format_exc())
+
+
+# 和服务器互相转发的消息
+# 用 __slots__ 代替每次 deepcopy 模板字典，序列化结果缓存起来，发送和写日志共用一份
+# 调用 to_json 之后就不要再修改了
+class BridgeMessage:
+    __slots__ = ('minecraft_name', 'minecraft_uuid', 'telegram_name', 'telegram_id', 'id', 'content', 'json_text')
+
+    def __init__(self, minecraft_name='', telegram_name='', telegram_id=0, message_id=0, minecraft_uuid=''):
+        self.minecraft_name = minecraft_name
+        self.minecraft_uuid = minecraft_uuid
+        self.telegram_name = telegram_name
+        self.telegram_id = telegram_id
+        self.id = message_id
+        self.content = []
+        self.json_text = None
+
+    def to_dict(self):
+        return {
+            'sender': {
+                'minecraft_name': self.minecraft_name,
+                'minecraft_uuid': self.minecraft_uuid,
+                'telegram_name': self.telegram_name,
+                'telegram_id': self.telegram_id,
+            },
+            'message': {
+                'id': self.id,
+                'content': self.content,
+            },
+        }
+
+    def to_json(self):
+        if self.json_text is None:
+            self.json_text = json.dumps(self.to_dict(), separators=(',', ':'))
+        return self.json_text
+
+
+# 给 socket.io 用的 json，遇到 BridgeMessage 直接拼接缓存好的 json
+class BridgeJSON:
+    loads = staticmethod(json.loads)
+
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        if isinstance(obj, list) and any(isinstance(item, BridgeMessage) for item in obj):
+            return '[' + ','.join(item.to_json() if isinstance(item, BridgeMessage)
+                                  else json.dumps(item, *args, **kwargs) for item in obj) + ']'
+        if isinstance(obj, BridgeMessage):
+            return obj.to_json()
+        return json.dumps(obj, *args, **kwargs)
 
 
 # 处理tg特殊字符
@@ -67,16 +1963,155 @@ config = read_data('config', '')
 
 if config['proxy_enabled']:
     apihelper.proxy = {'http': config['proxy']}
-bot = telebot.TeleBot(config['bot_token'], parse_mode='MARKDOWN')
+# 自建 Bot API 服务器或者测试用的假服务器，格式和 apihelper.API_URL 一样
+if config.get('api_url'):
+    apihelper.API_URL = config['api_url']
+
+
+# 记录每个 Bot API 请求的耗时和结果，每个线程一个 Session 复用连接
+def timed_request_sender(method, url, **kwargs):
+    api_method = url.rsplit('/', 1)[-1]
+    session = telebot.util.per_thread('metrics_session', requests.Session)
+    start = time.monotonic()
+    try:
+        response = session.request(method, url, **kwargs)
+    except Exception as e:
+        metrics.inc('telegram_api_requests_total', {'method': api_method, 'code': 'error'})
+        raise
+    finally:
+        elapsed = time.monotonic() - start
+        metrics.observe('telegram_api_seconds', elapsed, {'method': api_method})
+        tracer.add('api:' + api_method, elapsed)
+    metrics.inc('telegram_api_requests_total', {'method': api_method, 'code': response.status_code})
+    return response
+
+
+apihelper.CUSTOM_REQUEST_SENDER = timed_request_sender
+executor_config = config.get('executor') or {}
+handler_executor = KeyedExecutor(executor_config.get('workers', 4), executor_config.get('queue_size', 1000),
+                                 'handler')
+bot = OrderedTeleBot(config['bot_token'], parse_mode='MARKDOWN', executor=handler_executor)
 group_id = config['group_id']
 
+# 定时执行的会阻塞的任务（网络请求等）放在这里
+background_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='background')
+outbound_config = config.get('outbound') or {}
+outbound_limits = (outbound_config.get('group_per_minute', 20),
+                   outbound_config.get('private_per_second', 1),
+                   outbound_config.get('global_per_second', 30),
+                   outbound_config.get('max_retries', 3))
+
+# threaded：telebot 线程轮询 + socket.io 线程客户端
+# asyncio：Telegram 轮询、socket.io 和定时任务都在同一个事件循环里
+runtime_mode = config.get('runtime', 'threaded')
+if runtime_mode == 'asyncio':
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+
+    loop = asyncio.new_event_loop()
+    if config['proxy_enabled']:
+        asyncio_helper.proxy = config['proxy']
+    if config.get('api_url'):
+        asyncio_helper.API_URL = config['api_url']
+    abot = AsyncTeleBot(config['bot_token'], parse_mode='MARKDOWN')
+    # 原有的处理函数是同步的（读写存储、requests 请求），放到线程池里执行，不阻塞事件循环
+    handler_pool = ThreadPoolExecutor(max_workers=executor_config.get('workers', 4), thread_name_prefix='handler')
+    process_request = asyncio_helper._process_request
+
+    # asyncio_helper 没有公开的钩子，包一层内部的请求函数来记录耗时
+    async def timed_process_request(token, url, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            result = await process_request(token, url, *args, **kwargs)
+        except Exception as e:
+            metrics.inc('telegram_api_requests_total', {'method': url, 'code': getattr(e, 'error_code', 'error')})
+            raise
+        finally:
+            metrics.observe('telegram_api_seconds', time.monotonic() - start, {'method': url})
+        metrics.inc('telegram_api_requests_total', {'method': url, 'code': 200})
+        return result
+
+    asyncio_helper._process_request = timed_process_request
+    asio = socketio.AsyncClient(json=BridgeJSON, reconnection=False)
+    scheduler = AsyncScheduler(loop)
+    outbound = AsyncOutboundDispatcher(abot, loop, *outbound_limits)
+else:
+    scheduler = Scheduler()
+    outbound = OutboundDispatcher(bot, *outbound_limits)
+
+online_roster = OnlineRoster()
+
+# 获取图片路径（bot.get_file）的线程池
+media_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='media')
+file_path_cache = FilePathCache()
+
+status_config = config.get('status') or {}
+status_poller = StatusPoller(lambda: minestat.MineStat(config['server_ip'], config['server_port'],
+                                                       status_config.get('timeout', 5)),
+                             status_config.get('max_age', 120))
+
+coalesce_config = config.get('coalesce') or {}
+coalescer = EventCoalescer(coalesce_config.get('window', 1), coalesce_config.get('edit_window', 30))
+
+
+# 回复用户的命令，优先发送
+def reply_to(message_local, text, callback=None, **kwargs):
+    if str(message_local.chat.id) == str(group_id):
+        coalescer.interrupt()
+    outbound.submit(PRIORITY_REPLY, message_local.chat.id, 'reply_to', message_local, text, callback=callback,
+                    **kwargs)
+
+
+def send_admin(text):
+    outbound.submit(PRIORITY_CHAT, config['admin_id'], 'send_message', config['admin_id'], text)
+
+
+def delete_message(chat_id, message_id):
+    # 删除消息不计入聊天的发送频率
+    outbound.submit(PRIORITY_REPLY, None, 'delete_message', chat_id, message_id)
+
+
+storage_config = config.get('storage') or {}
+if storage_config.get('backend', 'json') == 'sqlite':
+    backend = SqliteBackend(storage_config.get('sqlite_path', 'data/bot.db'))
+    backend.migrate_from_json()
+else:
+    backend = JsonBackend(JsonStore('data', storage_config.get('flush_interval', 2)))
+
+
+# 退出前把还没写入的数据写完
+def shutdown(*args):
+    logger.info('正在退出')
+    backend.close()
+    os._exit(0)
+
+
+atexit.register(backend.close)
+signal.signal(signal.SIGTERM, shutdown)
+signal.signal(signal.SIGINT, shutdown)
+
+# tg id -> mc用户名
+id_index = IdentityIndex(backend, 'id')
+# tg id -> tg用户名
+username_index = IdentityIndex(backend, 'username_id')
+death_stats = DeathStats(backend)
+
+profile_cache_config = config.get('profile_cache') or {}
+profile_cache = ProfileCache(profile_cache_config.get('size', 1024),
+                             profile_cache_config.get('ttl', 600),
+                             profile_cache_config.get('negative_ttl', 300))
+
 help_text = f'''
 {config['bot_name']} 帮助菜单  
 `/status` - 获取服务器状态  
 `/performance` - 获取服务器性能信息
 `/list` - 获取服务器上的玩家列表  
+`/recent` - 查看最近一小时在线过的玩家
 `/death_list` - 查看总死亡榜
 `/death_list_daily` - 查看今日死亡榜
+`/death_list_week` - 查看近7天死亡榜
+`/death_list_month` - 查看近30天死亡榜
+`/deaths` - 查看某个玩家的死亡统计
 `/bind` - 绑定你的 MC 用户名  
 `/unbind` - 解绑你的 MC 用户名  
 `/get_me` - 获取你的信息
@@ -87,8 +2122,12 @@ bot.set_my_commands([
     telebot.types.BotCommand('/status', '服务器状态'),
     telebot.types.BotCommand('/performance', '服务器性能信息'),
     telebot.types.BotCommand('/list', '玩家列表'),
+    telebot.types.BotCommand('/recent', '最近一小时在线过的玩家'),
     telebot.types.BotCommand('/death_list', '总死亡榜'),
     telebot.types.BotCommand('/death_list_daily', '今日死亡榜'),
+    telebot.types.BotCommand('/death_list_week', '近7天死亡榜'),
+    telebot.types.BotCommand('/death_list_month', '近30天死亡榜'),
+    telebot.types.BotCommand('/deaths', '玩家死亡统计（手动输入 /deaths 用户名）'),
     telebot.types.BotCommand('/bind', '绑定 MC 用户名（手动输入 /bind 用户名）'),
     telebot.types.BotCommand('/unbind', '解绑 MC 用户名'),
     telebot.types.BotCommand('/get_me', '获取用户信息'),
@@ -100,52 +2139,137 @@ bot.set_my_commands([
 @bot.message_handler(commands=['help', 'start'])
 def send_welcome(message_local):
     logger.info({'help', str(message_local.from_user.username)})
-    bot.reply_to(message_local, help_text)
+    reply_to(message_local, help_text)
 
 
-def empty_callback(*args):
-    pass
+# 发送 socket.io 事件，异步模式下交给事件循环发送，不阻塞当前线程
+@tracer.traced('socket_emit')
+def emit(event, data=None, namespace=None, callback=None):
+    if runtime_mode == 'asyncio':
+        if callback:
+            # ack 的回调会在事件循环里调用，和处理函数一样放到线程池里执行
+            callback = functools.partial(loop.run_in_executor, handler_pool, callback)
+        asyncio.run_coroutine_threadsafe(asio.emit(event, data, namespace=namespace, callback=callback), loop)
+    else:
+        if callback:
+            # ack 的回调会在读取线程里调用，和处理函数一样按 namespace 交给 handler_executor
+            callback = functools.partial(handler_executor.submit, ('socket', namespace), callback)
+        sio.emit(event, data, namespace=namespace, callback=callback)
+
+
+def socket_connected():
+    if runtime_mode == 'asyncio':
+        return asio.connected
+    return sio.connected
+
+
+# 发给服务器的聊天消息，断线时先缓存，重连后补发
+def send_chat(message_to_send):
+    if supervisor.send('chat', message_to_send, '/message'):
+        logger.info('websocket 发送消息 ' + message_to_send.to_json())
+    else:
+        logger.info('websocket 未连接，消息已缓存 ' + message_to_send.to_json())
 
 
 @bot.message_handler(commands=['list'])
 def send_player_list(message_local):
     logger.info({'list', str(message_local.from_user.username)})
-    if sio.connected:
-        sio.emit('players', namespace='/status', callback=empty_callback)
+    snapshot = online_roster.snapshot()
+    if snapshot and socket_connected():
+        names, maximum = snapshot
+        reply_to(message_local, format_player_list(names, len(names), maximum))
+    elif socket_connected():
+        # 名单还没同步，向服务器查询
+        players_query.request(message_local)
+    else:
+        reply_to(message_local, 'socket 未连接')
+        supervisor.wake()
+
+
+@bot.message_handler(commands=['recent'])
+def send_recent_players(message_local):
+    logger.info({'recent', str(message_local.from_user.username)})
+    names = online_roster.recent(3600)
+    if names:
+        reply_to(message_local, '最近一小时在线过的玩家:\n' + ', '.join(format_player_name(name) for name in names))
     else:
-        bot.reply_to(message_local, 'socket 未连接')
-        ws_reconnect()
+        reply_to(message_local, '最近一小时没有玩家在线')
 
 
 @bot.message_handler(commands=['status'])
 def send_server_status(message_local):
     logger.info({'status', str(message_local.from_user.username)})
-    ms = get_server_status()
+    # 缓存太旧时在刷新完成后回复，不占用处理消息的线程
+    status_poller.get(functools.partial(reply_server_status, message_local))
+
+
+def reply_server_status(message_local, ms, age):
     status = f'{config["server_name"]} 服务器状态\n'
     status += f'服务器地址：`{config["server_ip_export"]}`\n'
+    if ms is None:
+        reply_to(message_local, status + '暂时无法获取服务器状态')
+        return
     if ms.online:
         status += '服务器版本：' + ms.version + '\n'
         status += '在线玩家数：' + str(ms.current_players) + '/' + str(ms.max_players) + '\n'
-        status += '服务器描述：' + ms.stripped_motd
-        bot.reply_to(message_local, status)
+        status += '服务器描述：' + ms.stripped_motd + '\n'
     else:
-        bot.reply_to(message_local, status + '服务器离线')
+        status += '服务器离线\n'
+    reply_to(message_local, status + f'数据更新于 {int(age)} 秒前')
 
 
 @bot.message_handler(commands=['getID'])
 def send_welcome(message_local):
-    bot.reply_to(message_local, message_local.chat.id)
+    reply_to(message_local, message_local.chat.id)
 
 
 @bot.message_handler(commands=['performance'])
 def send_performance(message_local):
     logger.info({'performance', str(message_local.from_user.username)})
 
-    if sio.connected:
-        sio.emit('performance', namespace='/status', callback=empty_callback)
+    if socket_connected():
+        performance_query.request(message_local)
     else:
-        bot.reply_to(message_local, 'socket 未连接')
-        ws_reconnect()
+        reply_to(message_local, 'socket 未连接')
+        supervisor.wake()
+
+
+profile_lock = threading.Lock()
+
+
+# 在单独的线程里采样，结束后把结果作为文件发回去
+def run_profile(chat_id, seconds):
+    try:
+        profiler = SamplingProfiler(profiling_config.get('sample_interval_ms', 10) / 1000)
+        profiler.run(seconds)
+        report = profiler.report(profiling_config.get('top', 50))
+        outbound.submit(PRIORITY_REPLY, chat_id, 'send_document', chat_id, report.encode('utf-8'),
+                        visible_file_name=f'profile_{datetime.now():%Y%m%d_%H%M%S}.txt',
+                        caption=f'采样 {seconds} 秒')
+    except Exception as e:
+        logger.error(traceback.format_exc())
+    finally:
+        profile_lock.release()
+
+
+# 管理员命令：/profile [秒数]，对整个进程采样分析
+@bot.message_handler(commands=['profile'])
+def send_profile(message_local):
+    logger.info({'profile', str(message_local.from_user.username)})
+    if str(message_local.from_user.id) != str(config['admin_id']):
+        return
+    max_seconds = profiling_config.get('max_seconds', 60)
+    try:
+        seconds = int(telebot.util.extract_arguments(message_local.text) or 10)
+    except ValueError:
+        reply_to(message_local, '用法：/profile [秒数]')
+        return
+    seconds = max(1, min(seconds, max_seconds))
+    if not profile_lock.acquire(blocking=False):
+        reply_to(message_local, '已经在采样了')
+        return
+    threading.Thread(target=run_profile, args=(message_local.chat.id, seconds), name='profile', daemon=True).start()
+    reply_to(message_local, f'开始采样 {seconds} 秒')
 
 
 @bot.message_handler(commands=['bind'])
@@ -155,64 +2279,80 @@ def bind_mc(message_local):
         # 判断是否有@机器人用户名
         if message_local.text.find(config['bot_username']) != -1:
             # 发送消息
-            bot.reply_to(message_local, '请手动输入 `/bind 用户名`')
+            reply_to(message_local, '请手动输入 `/bind 用户名`')
             return
 
         pattern = re.compile(r'^\w+$')
         if not pattern.match(message_local.text[6:]):
-            bot.reply_to(message_local, 'MC 用户名只能包含英文、数字和下划线')
+            reply_to(message_local, 'MC 用户名只能包含英文、数字和下划线')
             return
-        id_data = read_data('id')
         # 判断有没有人绑定过这个mc用户名
         player_id = get_id_by_mc_username(message_local.text[6:])
         if player_id:
-            bot.reply_to(message_local,
-                         f'这个 MC 用户名已经被 {get_tg_username_by_id(player_id)} 绑定过了')
+            reply_to(message_local,
+                     f'这个 MC 用户名已经被 {get_tg_username_by_id(player_id)} 绑定过了')
             return
 
-        id_data[str(message_local.from_user.id)] = message_local.text[6:]
-        write_data('id', id_data)
-        bot.reply_to(message_local, f'绑定成功：`{message_local.text[6:]}`')
+        id_index.set(message_local.from_user.id, message_local.text[6:])
+        reply_to(message_local, f'绑定成功：`{message_local.text[6:]}`')
     else:
-        bot.reply_to(message_local, '请在 `/bind` 命令后面加上你的 MC 用户名')
+        reply_to(message_local, '请在 `/bind` 命令后面加上你的 MC 用户名')
 
     # 判断tg用户名是否为空
     if message_local.from_user.username:
-        username_id_data = read_data('username_id')
-        username_id_data[str(message_local.from_user.id)] = message_local.from_user.username
-        write_data('username_id', username_id_data)
+        username_index.set(message_local.from_user.id, message_local.from_user.username)
 
 
 @bot.message_handler(commands=['unbind'])
 def unbind_mc(message_local):
     logger.info({'unbind', str(message_local.from_user.username)})
-    id_data = read_data('id')
-    if str(message_local.from_user.id) in id_data:
-        del id_data[str(message_local.from_user.id)]
-        write_data('id', id_data)
-        bot.reply_to(message_local, '解绑成功')
+    if id_index.remove(message_local.from_user.id):
+        reply_to(message_local, '解绑成功')
     else:
-        bot.reply_to(message_local, '你还没有绑定 MC 用户名')
+        reply_to(message_local, '你还没有绑定 MC 用户名')
 
 
 @bot.message_handler(commands=['get_me'])
 def get_me(message_local):
     logger.info({'get_me', str(message_local.from_user.username)})
-    userinfo = bot.get_chat(message_local.from_user.id)
     reply_str = f'''
-你的用户名：`{userinfo.username}`
-你的 ID：`{userinfo.id}`
+你的用户名：`{message_local.from_user.username}`
+你的 ID：`{message_local.from_user.id}`
 '''
-    if read_data('id').get(str(message_local.from_user.id)):
-        reply_str += f'你绑定的 MC 用户名：`{read_data("id").get(str(message_local.from_user.id))}`'
+    mc_username = get_mc_username_by_id(message_local.from_user.id)
+    if mc_username:
+        reply_str += f'你绑定的 MC 用户名：`{mc_username}`'
     else:
         reply_str += '你还没有绑定 MC 用户名'
-    bot.reply_to(message_local, reply_str)
+    reply_to(message_local, reply_str)
 
     if message_local.from_user.username:
-        username_id_data = read_data('username_id')
-        username_id_data[str(message_local.from_user.id)] = message_local.from_user.username
-        write_data('username_id', username_id_data)
+        username_index.set(message_local.from_user.id, message_local.from_user.username)
+
+
+# 回复的图片：有缓存就带上路径，没有就只显示 [图片]，同时预取路径给之后用
+def reply_photo_path(photo):
+    file_path = file_path_cache.get(photo.file_unique_id)
+    if file_path:
+        return ' (' + file_path + ')'
+    file_path_cache.resolve(photo.file_id, photo.file_unique_id)
+    return ''
+
+
+# 图片路径获取到之后，单独给服务器发一条只有图片的消息
+def emit_media(original, content_type, file_path):
+    message_to_send = BridgeMessage(original.minecraft_name, original.telegram_name, original.telegram_id,
+                                    original.id)
+    message_to_send.content.append({
+        'type': content_type,
+        'id': None,
+        'content': file_path,
+    })
+    send_chat(message_to_send)
+
+
+# Unicode BMP 以外的字符（大部分 emoji）
+astral_pattern = re.compile('[\U00010000-\U0010ffff]')
 
 
 # 分割@与消息
@@ -223,94 +2363,87 @@ def parse_message(text, entities):
             'id': None,
             'content': text
         }]
+    # entity 的 offset 和 length 是按 UTF-16 算的，emoji 之类 BMP 以外的字符在 UTF-16 里占两个单位
+    # 只有文本里有这种字符时才换算：记下它们在 UTF-16 里的位置，offset 减去前面有几个这种字符就是 str 的下标
+    # 最后一个 entity 之后的字符不影响换算，不用找
+    if len(text.encode('utf-16-le')) != len(text) * 2:
+        last_end = max(entity.offset + entity.length for entity in entities)
+        astral = [match.start() + i for i, match in enumerate(astral_pattern.finditer(text, 0, last_end))]
     else:
-        message_local = []
-        # 遍历entities
-        for entity in entities:
-            # 判断是不是第一个entity
-            if entity == entities[0]:
-                # 判断entity前面的字符串是否为空
-                if text[:entity.offset] != '':
-                    # 如果是第一个entity就去掉后面的空格并且添加到message
-                    message_local.append({
-                        'type': 'text',
-                        'id': None,
-                        'content': text[:entity.offset].strip()
-                    })
-
-            # 判断是否为mention
-            if entity.type == 'mention':
-                # 截取@后面的用户名
-                user_name = text[entity.offset + 1:entity.offset + entity.length]
-                message_local.append({'type': 'at',
-                                      'id': get_id_by_tg_username(user_name),
-                                      'content': user_name,
-                                      })
-            elif entity.type == 'text_mention':
-                message_local.append({'type': 'at',
-                                      'id': entity.user.id,
-                                      'content': get_tg_username_by_id_noformat(entity.user.id)})
-            else:
-                # 否则就是普通文本
-                message_local.append({
-                    'type': 'text',
-                    'id': None,
-                    'content': text[entity.offset:entity.offset + entity.length]
-                })
+        astral = None
+
+    message_local = []
+    # 上一个 entity 的结束位置
+    cursor = 0
+    for entity in entities:
+        start = entity.offset
+        end = start + entity.length
+        if astral:
+            start -= bisect_left(astral, start)
+            end -= bisect_left(astral, end)
+        # 嵌套在上一个 entity 里面的跳过
+        if start < cursor:
+            continue
+        # entity 前面的文本去掉首尾空格
+        if start > cursor:
+            message_local.append({
+                'type': 'text',
+                'id': None,
+                'content': text[cursor:start].strip()
+            })
 
-            # 判断如果不是最后一个entity
-            if entity != entities[-1]:
-                # 判断和下一个entity之间的字符串是否为空
-                if text[entity.offset + entity.length:entities[entities.index(entity) + 1].offset] != '':
-                    # 如果不为空就去掉首尾空格并且添加到message
-                    message_local.append({
-                        'type': 'text',
-                        'id': None,
-                        'content': text[entity.offset + entity.length:entities[
-                            entities.index(entity) + 1].offset].strip()
-                    })
-            else:
-                # 判断后面的字符串是否为空
-                if text[entity.offset + entity.length:] != '':
-                    # 如果是最后一个entity就去掉前面的空格并且添加到message
-                    message_local.append({
-                        'type': 'text',
-                        'id': None,
-                        'content': text[entity.offset + entity.length:].strip()
-                    })
+        if entity.type == 'mention':
+            # 截取@后面的用户名
+            user_name = text[start + 1:end]
+            message_local.append({'type': 'at',
+                                  'id': get_id_by_tg_username(user_name),
+                                  'content': user_name,
+                                  })
+        elif entity.type == 'text_mention':
+            message_local.append({'type': 'at',
+                                  'id': entity.user.id,
+                                  'content': get_tg_username_by_id_noformat(entity.user.id)})
+        else:
+            # 否则就是普通文本
+            message_local.append({
+                'type': 'text',
+                'id': None,
+                'content': text[start:end]
+            })
+        cursor = end
 
-        return message_local
+    # 最后一个 entity 后面的文本
+    tail = text[cursor:]
+    if tail != '':
+        message_local.append({
+            'type': 'text',
+            'id': None,
+            'content': tail.strip()
+        })
+    return message_local
 
 
 # 在tg里@mc用户名并且发送到ws
 @bot.message_handler(commands=['at'])
 def at_mc(message_local):
-    if not sio.connected:
-        bot.reply_to(message_local, 'socket 未连接')
-        ws_reconnect()
-        return
     logger.info({'at', str(message_local.from_user.username)})
     if message_local.text[4:] != '':
         # 判断是否有@机器人用户名
         if message_local.text.find(config['bot_username']) != -1:
             # 发送消息
-            bot.reply_to(message_local, '请手动输入 `/at 用户名`')
+            reply_to(message_local, '请手动输入 `/at 用户名`')
             return
 
-        id_data = read_data('id')
         # 判断用户是否绑定
-        if str(message_local.from_user.id) in id_data:
-            player_id = get_id_by_mc_username(id_data[str(message_local.from_user.id)])
-
-            # 复制message模板
-            message_to_send = copy.deepcopy(message_template)
+        mc_username = get_mc_username_by_id(message_local.from_user.id)
+        if mc_username:
+            player_id = get_id_by_mc_username(mc_username)
 
             if player_id:
-                message_to_send['sender']['minecraft_name'] = get_mc_username_by_id(player_id) or 'UNBOUND'
-                message_to_send['sender']['telegram_name'] = get_tg_username_by_id_noformat(player_id) or 'UNBOUND'
-                message_to_send['sender']['telegram_id'] = player_id
-                message_to_send['message']['id'] = message_local.message_id
-                message_to_send['message']['content'].append({
+                message_to_send = BridgeMessage(get_mc_username_by_id(player_id) or 'UNBOUND',
+                                                get_tg_username_by_id_noformat(player_id) or 'UNBOUND',
+                                                player_id, message_local.message_id)
+                message_to_send.content.append({
                     'type': 'at',
                     'id': None,
                     # @的用户名（从第5个字符到空格处（如果没有空格就是到最后））
@@ -318,92 +2451,128 @@ def at_mc(message_local):
                 })
                 # 判断是否有第二个空格
                 if len(message_local.text[4:].split(' ')) > 1:
-                    message_to_send['message']['content'].append({
+                    message_to_send.content.append({
                         'type': 'text',
                         'id': None,
                         # @后面的消息（从第2个空格到最后（如果没有第二个空格就返回None））
                         'content': ' '.join(message_local.text[4:].split(' ')[1:]),
                     })
-                sio.emit('chat', message_to_send, namespace='/message')
-                logger.info('websocket 发送消息 ' + json.dumps(message_to_send))
-                result_message = bot.reply_to(message_local, f'已发送')
+                send_chat(message_to_send)
                 # 五秒后删除消息
-                time.sleep(5)
-                bot.delete_message(message_local.chat.id, result_message.message_id)
+                reply_to(message_local, '已发送' if supervisor.connected() else 'socket 未连接，连接后会自动发送',
+                         callback=lambda result_message: scheduler.call_later(
+                             5, delete_message, message_local.chat.id, result_message.message_id))
 
         else:
-            bot.reply_to(message_local, '你需要先绑定 MC 用户名')
+            reply_to(message_local, '你需要先绑定 MC 用户名')
     else:
-        bot.reply_to(message_local, '请在 `/at` 命令后面加上你要 @ 的 MC 用户名')
+        reply_to(message_local, '请在 `/at` 命令后面加上你要 @ 的 MC 用户名')
 
 
-# 死亡榜总榜
-@bot.message_handler(commands=['death_list'])
-def death_list(message_local):
-    logger.info({'death_list', str(message_local.from_user.username)})
-    death_all_data = read_data('death_all')
-    death_all_data_sorted = sorted(death_all_data.items(), key=lambda x: x[1], reverse=True)
-    death_all_str = '总死亡榜\n'
-    if len(death_all_data_sorted) == 0:
-        death_all_str += '暂无数据'
-    else:
-        # 如果超过10个人就只显示前10个
-        if len(death_all_data_sorted) > 10:
-            death_all_data_sorted = death_all_data_sorted[:10]
-        for i, death_all_data_sorted_item in enumerate(death_all_data_sorted, start=1):
-            player_id = get_id_by_mc_username(death_all_data_sorted_item[0])
-            if player_id:
-                death_all_str += f'{i}. `{death_all_data_sorted_item[0]}` ({get_tg_username_by_id(player_id)})：*{death_all_data_sorted_item[1]}*次\n'
-            else:
-                death_all_str += f'`{i}. {death_all_data_sorted_item[0]}`：*{death_all_data_sorted_item[1]}*次\n'
-    bot.reply_to(message_local, death_all_str, disable_web_page_preview=True)
-
-
-# 死亡榜日榜
-@bot.message_handler(commands=['death_list_daily'])
-def death_list_daily(message_local):
-    logger.info({'death_list_daily', str(message_local.from_user.username)})
-    death_daily_data = read_data('death_daily')
-    if not death_daily_data.get('data'):
-        death_daily_data['data'] = {}
-    death_daily_data_sorted = sorted(death_daily_data['data'].items(), key=lambda x: x[1], reverse=True)
-    death_daily_str = '今日死亡榜\n'
-    if len(death_daily_data_sorted) == 0:
-        death_daily_str += '暂无数据'
-    else:
-        if death_daily_data['date'] != datetime.now().strftime('%Y-%m-%d'):
-            death_daily_str += '暂无数据'
+def render_death_list(title, rows):
+    death_list_str = title + '\n'
+    if len(rows) == 0:
+        death_list_str += '暂无数据'
+    for i, (player_name, count) in enumerate(rows, start=1):
+        player_id = get_id_by_mc_username(player_name)
+        if player_id:
+            death_list_str += f'{i}. `{player_name}` ({get_tg_username_by_id(player_id)})：*{count}*次\n'
         else:
-            # 如果超过10个人就只显示前10个
-            if len(death_daily_data_sorted) > 10:
-                death_daily_data_sorted = death_daily_data_sorted[:10]
-            for i, death_daily_data_sorted_item in enumerate(death_daily_data_sorted, start=1):
-                player_id = get_id_by_mc_username(death_daily_data_sorted_item[0])
-                if player_id:
-                    death_daily_str += f'{i}. `{death_daily_data_sorted_item[0]}` ({get_tg_username_by_id(player_id)})：*{death_daily_data_sorted_item[1]}*次\n'
-                else:
-                    death_daily_str += f'`{i}. {death_daily_data_sorted_item[0]}`：*{death_daily_data_sorted_item[1]}*次\n'
-    bot.reply_to(message_local, death_daily_str, disable_web_page_preview=True)
+            death_list_str += f'`{i}. {player_name}`：*{count}*次\n'
+    return death_list_str
+
+
+# 渲染好的死亡榜缓存：window -> (版本, 过期时间, 文本)
+# 只有死亡数据变化、跨天、绑定变化，或者里面的用户名缓存过期时才重新渲染
+leaderboard_cache = {}
+leaderboard_lock = threading.Lock()
+
+
+def get_death_list_text(window, title):
+    # 绑定的版本号在渲染前取，渲染期间绑定变了下次会重新渲染
+    id_version = id_index.version
+    # top 会在跨天时重新汇总窗口并更新版本号，拿着锁读，数据和版本号一致
+    with death_stats.lock:
+        rows = death_stats.top(window)
+        stamp = (death_stats.version, id_version)
+    cached = leaderboard_cache.get(window)
+    if cached and cached[0] == stamp and cached[1] > time.monotonic():
+        return cached[2]
+    # 同一时间只渲染一次，其余请求等渲染完直接用缓存
+    with leaderboard_lock:
+        cached = leaderboard_cache.get(window)
+        if cached and cached[0] == stamp and cached[1] > time.monotonic():
+            return cached[2]
+        text = render_death_list(title, rows)
+        leaderboard_cache[window] = (stamp, time.monotonic() + profile_cache.ttl, text)
+    return text
+
+
+# 死亡榜命令 -> (窗口, 标题)
+death_list_windows = {
+    'death_list': ('all', '总死亡榜'),
+    'death_list_daily': ('day', '今日死亡榜'),
+    'death_list_week': ('week', '近7天死亡榜'),
+    'death_list_month': ('month', '近30天死亡榜'),
+}
+
+
+@bot.message_handler(commands=list(death_list_windows))
+def death_list(message_local):
+    command = telebot.util.extract_command(message_local.text)
+    logger.info({command, str(message_local.from_user.username)})
+    window, title = death_list_windows[command]
+    reply_to(message_local, get_death_list_text(window, title), disable_web_page_preview=True)
+
+
+# 死因的显示文本，死因格式为 翻译key|凶手
+def describe_death_cause(cause):
+    death_format, _, killer = cause.partition('|')
+    if killer:
+        killer = f' {translate(killer)} ' if has_translation(killer) else f' `{killer}` '
+    return get_template(death_format).render('', killer, '').strip()
+
+
+# 某个玩家的死亡统计，不加用户名则查询自己绑定的
+@bot.message_handler(commands=['deaths'])
+def player_deaths(message_local):
+    logger.info({'deaths', str(message_local.from_user.username)})
+    player_name = message_local.text[8:].strip()
+    if player_name.find(config['bot_username']) != -1:
+        reply_to(message_local, '请手动输入 `/deaths 用户名`')
+        return
+    if not player_name:
+        player_name = get_mc_username_by_id(message_local.from_user.id)
+        if not player_name:
+            reply_to(message_local, '请在 `/deaths` 命令后面加上 MC 用户名，或者先绑定 MC 用户名')
+            return
+
+    stats = death_stats.player(player_name)
+    deaths_str = f'`{player_name}` 的死亡统计\n'
+    if not stats['all']:
+        reply_to(message_local, deaths_str + '暂无数据')
+        return
+    deaths_str += f'总死亡：*{stats["all"]}*次（第 {stats["rank"]} 名）\n'
+    deaths_str += f'今日：*{stats["day"]}*次  近7天：*{stats["week"]}*次  近30天：*{stats["month"]}*次\n'
+    if stats['causes']:
+        deaths_str += '常见死因：\n'
+        for cause, count in stats['causes']:
+            deaths_str += f'{describe_death_cause(cause)}：*{count}*次\n'
+    reply_to(message_local, deaths_str, disable_web_page_preview=True)
 
 
 @bot.message_handler(func=lambda message: True,
                      content_types=['text', 'photo', 'video', 'audio', 'voice', 'sticker', 'document'])
 def if_all(message_local):
-    if not sio.connected:
-        ws_reconnect()
-        return
+    if str(message_local.chat.id) == str(group_id):
+        coalescer.interrupt()
     try:
         logger.info(
             {'telegram 收到消息', message_local.content_type, message_local.text, message_local.from_user.username})
 
-        # 复制message模板
-        message_to_send = copy.deepcopy(message_template)
-
-        message_to_send['sender']['minecraft_name'] = get_mc_username_by_id(message_local.from_user.id) or 'UNBOUND'
-        message_to_send['sender']['telegram_name'] = get_tg_username_by_id_noformat(
-            message_local.from_user.id) or 'UNBOUND'
-        message_to_send['sender']['telegram_id'] = message_local.from_user.id
-        message_to_send['message']['id'] = message_local.message_id
+        message_to_send = BridgeMessage(get_mc_username_by_id(message_local.from_user.id) or 'UNBOUND',
+                                        get_tg_username_by_id_noformat(message_local.from_user.id) or 'UNBOUND',
+                                        message_local.from_user.id, message_local.message_id)
 
         if message_local.reply_to_message:
             reply_str = ''
@@ -423,9 +2592,8 @@ def if_all(message_local):
                 reply_str = '[' + content_type_zh[message_local.reply_to_message.content_type] + ']'
 
                 if message_local.reply_to_message.content_type == 'photo':
-                    if message_local.photo:
-                        file = bot.get_file(message_local.photo[-1].file_id)
-                        reply_str += ' (' + file.file_path + ')'
+                    if message_local.reply_to_message.photo:
+                        reply_str += reply_photo_path(message_local.reply_to_message.photo[-1])
                     else:
                         reply_str += ' (无法获取)'
                 elif message_local.reply_to_message.content_type == 'video':
@@ -453,7 +2621,7 @@ def if_all(message_local):
                     reply_str += ' ' + message_local.reply_to_message.caption
 
             if reply_str != '':
-                message_to_send['message']['content'].append({
+                message_to_send.content.append({
                     'type': 'reply',
                     'id': message_local.reply_to_message.message_id,
                     'content': reply_str,
@@ -462,52 +2630,56 @@ def if_all(message_local):
         if message_local.content_type == 'text':
             if message_local.text.find('好烧') != -1 or message_local.text.find('烧起来') != -1 \
                     or message_local.text.find('🥵') != -1:
-                bot.send_message(message_local.chat.id, '🥵🥵🥵')
+                outbound.submit(PRIORITY_CHAT, message_local.chat.id, 'send_message', message_local.chat.id, '🥵🥵🥵')
 
             # if read_data('id').get(str(message.from_user.id)):
-            # 给message_to_send['content']['message']添加{'type': 'text', 'content': 'xxx'}
-            message_to_send['message']['content'].extend(parse_message(message_local.text,
-                                                                       message_local.entities))
-            sio.emit('chat', message_to_send, namespace='/message')
-            logger.info('websocket 发送消息 ' + json.dumps(message_to_send))
+            # 给 message_to_send.content 添加{'type': 'text', 'content': 'xxx'}
+            message_to_send.content.extend(parse_message(message_local.text, message_local.entities))
+            send_chat(message_to_send)
 
         else:
             # if read_data('id').get(str(message.from_user.id)):
             if message_local.content_type == 'photo':
-                file = bot.get_file(message_local.photo[-1].file_id)
-                message_to_send['message']['content'].append({
-                    'type': 'photo',
-                    'id': None,
-                    'content': file.file_path,
-                })
+                photo = message_local.photo[-1]
+                file_path = file_path_cache.get(photo.file_unique_id)
+                if file_path:
+                    message_to_send.content.append({
+                        'type': 'photo',
+                        'id': None,
+                        'content': file_path,
+                    })
+                else:
+                    # 先发文字部分，图片路径获取到之后再单独发一条
+                    file_path_cache.resolve(photo.file_id, photo.file_unique_id,
+                                            lambda path, original=message_to_send: emit_media(original, 'photo', path))
             elif message_local.content_type == 'video':
-                message_to_send['message']['content'].append({
+                message_to_send.content.append({
                     'type': 'video',
                     'id': None,
                     # 文件名
                     'content': message_local.video.file_name,
                 })
             elif message_local.content_type == 'audio':
-                message_to_send['message']['content'].append({
+                message_to_send.content.append({
                     'type': 'audio',
                     'id': None,
                     # 文件名
                     'content': message_local.audio.file_name,
                 })
             elif message_local.content_type == 'voice':
-                message_to_send['message']['content'].append({
+                message_to_send.content.append({
                     'type': 'voice',
                     'id': None,
                     'content': None
                 })
             elif message_local.content_type == 'sticker':
-                message_to_send['message']['content'].append({
+                message_to_send.content.append({
                     'type': 'sticker',
                     'id': None,
                     'content': message_local.sticker.emoji,
                 })
             elif message_local.content_type == 'document':
-                message_to_send['message']['content'].append({
+                message_to_send.content.append({
                     'type': 'document',
                     'id': None,
                     # 文件名
@@ -516,40 +2688,40 @@ def if_all(message_local):
 
             if message_local.caption:
                 # print(message.caption)
-                message_to_send['message']['content'].extend(parse_message(message_local.caption,
-                                                                           message_local.caption_entities))
-            sio.emit('chat', message_to_send, namespace='/message')
-            logger.info('websocket 发送消息 ' + json.dumps(message_to_send))
+                message_to_send.content.extend(parse_message(message_local.caption,
+                                                             message_local.caption_entities))
+            # 图片路径还没获取到并且没有说明文字时，等图片路径获取到再发
+            if message_to_send.content:
+                send_chat(message_to_send)
 
         if message_local.from_user.username:
-            username_id_data = read_data('username_id')
-            username_id_data[str(message_local.from_user.id)] = message_local.from_user.username
-            write_data('username_id', username_id_data)
+            # 用户名没变时不会写文件，变了就让资料缓存失效
+            if username_index.set(message_local.from_user.id, message_local.from_user.username):
+                profile_cache.invalidate(message_local.from_user.id)
     except Exception as e:
         traceback_info = traceback.format_exc()
         logger.error(traceback_info)
 
 
-def send_message(content, disable_web_page_preview=True):
+# 放进发送队列就返回，发送成功后用发出的消息调用 callback
+def send_message(content, disable_web_page_preview=True, priority=PRIORITY_BULK, callback=None, **kwargs):
     logger.info({'tg 发送消息', content})
-    bot.send_message(group_id, content, disable_web_page_preview=disable_web_page_preview)
+    coalescer.interrupt()
+    outbound.submit(priority, group_id, 'send_message', group_id, content,
+                    disable_web_page_preview=disable_web_page_preview, callback=callback, **kwargs)
 
 
 def tg_polling():
     logger.info('telegram 启动轮询')
     try:
+        # 之前用过 webhook 的话要先删除，否则不能轮询
+        bot.remove_webhook()
         bot.infinity_polling(logger_level=None)
     except Exception as e:
         traceback_info = traceback.format_exc()
         logger.error(traceback_info)
 
 
-tr_tg_polling = threading.Thread(target=tg_polling)
-tr_tg_polling.start()
-
-bot.send_message(config['admin_id'], '机器人，启动！')
-
-
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, datetime):
@@ -567,117 +2739,178 @@ def compare_arrays(array1, array2):
     return list(added_local), list(removed_local)
 
 
-def get_server_status():
-    return minestat.MineStat(config['server_ip'], config['server_port'])
-
-
 def get_player_list(ms_local):
     if ms_local.online:
         return ms_local.player_list
 
 
+def format_player_name(name):
+    player_id = get_id_by_mc_username(name)
+    if player_id:
+        return f'`{name}` ({get_tg_username_by_id(player_id)})'
+    return f'`{name}`'
+
+
+def format_player_list(names, current, maximum):
+    res_str = f'当前在线玩家数: {current} / {maximum}'
+    # 判断玩家列表是否为空
+    if names:
+        res_str += '\n玩家列表:\n' + ', '.join(format_player_name(name) for name in names)
+    return res_str
+
+
+# ack 回来的数据可能已经是对象，广播的事件是 json 字符串
+def load_event_data(data):
+    if isinstance(data, (str, bytes)):
+        return json.loads(data)
+    return data
+
+
+def handle_players(data):
+    data_json = load_event_data(data)
+    names = [player['name'] for player in data_json['players']]
+    online_roster.reconcile(names, data_json['maximum'])
+    return format_player_list(names, data_json['current'], data_json['maximum'])
+
+
+def handle_performance(data):
+    data_json = load_event_data(data)
+    return f'TPS: {str(round(data_json["tps"], 3))}\n' \
+           f'MSPT: {str(round(data_json["mspt"], 3))}\n'
+
+
+players_query = StatusQuery('players', handle_players)
+performance_query = StatusQuery('performance', handle_performance)
+
+
+# 静默查询一次在线玩家，用来校正在线名单
+# 服务器可能通过 ack 或者 players 事件返回，两种都走 players_query 更新名单
+def sync_roster():
+    # 异步模式下连接的处理函数在 asio.connected 变成 True 之前执行，用 supervisor 的状态判断
+    if supervisor.connected():
+        emit('players', namespace='/status', callback=players_query.on_ack)
+
+
 # 通过mc用户名判断是否绑定，如果绑定则返回对应的id
 def get_id_by_mc_username(mc_username):
-    data_id = read_data('id')
-    if mc_username in data_id.values():
-        return [k for k, v in data_id.items() if v == mc_username][0]
-    else:
-        return None
+    return id_index.get_key(mc_username)
 
 
 # 通过id获取mc用户名
 def get_mc_username_by_id(user_id):
-    data_id = read_data('id')
-    if str(user_id) in data_id.keys():
-        return data_id[str(user_id)]
-    else:
-        return None
+    return id_index.get(user_id)
 
 
 def get_tg_username_by_id(user_id):
-    if not user_id:
-        return None
-    try:
-        userinfo = bot.get_chat(user_id)
-        # 判断是否有tg昵称
-        if userinfo.username:
-            # 判断是否有last_name
-            if userinfo.last_name:
-                ret_str = f'[{userinfo.first_name} {userinfo.last_name}](t.me/{userinfo.username})'
-            else:
-                ret_str = f'[{userinfo.first_name}](t.me/{userinfo.username})'
-        else:
-            if userinfo.last_name:
-                ret_str = f'{userinfo.first_name} {userinfo.last_name}'
-            else:
-                ret_str = f'{userinfo.first_name}'
-        if ret_str:
-            return ret_str
-        else:
-            return None
-    except Exception as e:
-        traceback_info = traceback.format_exc()
-        if str(e).find('chat not found') != -1:
-            logger.error(e)
-        else:
-            logger.error(traceback_info)
-        return None
+    profile = get_tg_profile(user_id)
+    if profile:
+        return profile['format']
+    return None
 
 
 def get_tg_username_by_id_noformat(user_id):
-    if not user_id:
-        return None
-    try:
-        userinfo = bot.get_chat(user_id)
-        if userinfo.last_name:
-            ret_str = f'{userinfo.first_name} {userinfo.last_name}'
-        else:
-            ret_str = f'{userinfo.first_name}'
-        if ret_str:
-            return ret_str
-        else:
-            return None
-    except Exception as e:
-        traceback_info = traceback.format_exc()
-        if str(e).find('chat not found') != -1:
-            logger.error(e)
-        else:
-            logger.error(traceback_info)
-        return None
+    profile = get_tg_profile(user_id)
+    if profile:
+        return profile['noformat']
+    return None
 
 
 def get_id_by_tg_username(tg_username):
-    data_id = read_data('username_id')
-    if tg_username in data_id.values():
-        return [k for k, v in data_id.items() if v == tg_username][0]
-    else:
-        return None
-
+    return username_index.get_key(tg_username)
+
+
+# 服务器聊天内容的转换（路径点、@ 等），每个转换器同时生成 Telegram Markdown 和发回服务器的纯文本
+# 所有转换器的正则合并成一个，每段文本只扫描一次
+# 转换器名 -> (正则, 渲染函数)，渲染函数接收 match，返回 (markdown, 纯文本)
+chat_transformers = {}
+chat_transform_pattern = None
+
+
+# 注册一个转换器，正则里的命名分组请用转换器名开头，避免和别的转换器重名
+def register_chat_transformer(name, pattern, render):
+    global chat_transform_pattern
+    chat_transformers[name] = (pattern, render)
+    chat_transform_pattern = re.compile('|'.join(f'(?P<{transformer_name}>{transformer_pattern})'
+                                                 for transformer_name, (transformer_pattern, _)
+                                                 in chat_transformers.items()))
+
+
+@tracer.traced('transform_chat_text')
+def transform_chat_text(text):
+    markdown_parts = []
+    plain_parts = []
+    position = 0
+    for match in chat_transform_pattern.finditer(text):
+        if match.start() > position:
+            markdown_parts.append(tg_escape(text[position:match.start()]))
+            plain_parts.append(text[position:match.start()])
+        # 外层分组最后结束，lastgroup 就是转换器名
+        markdown, plain = chat_transformers[match.lastgroup][1](match)
+        markdown_parts.append(markdown)
+        plain_parts.append(plain)
+        position = match.end()
+    if position == 0:
+        return tg_escape(text), text
+    markdown_parts.append(tg_escape(text[position:]))
+    plain_parts.append(text[position:])
+    return ''.join(markdown_parts), ''.join(plain_parts)
+
+
+waypoint_world_names = {
+    # xaero
+    'Internal-overworld-waypoints': '主世界',
+    'Internal-the-nether-waypoints': '下界',
+    'Internal-the-end-waypoints': '末地',
+    # journeymap
+    'minecraft:overworld': '主世界',
+    'minecraft:the_nether': '下界',
+    'minecraft:the_end': '末地',
+}
 
-# 判断字符串是否为空，如果为空则直接设置这个字符串为另一个字符串，如果不为空则在后面加上分隔符再加另一个字符串
-def set_str_if_empty(str1, str2, separator):
-    if str1 == '':
-        return str2
-    else:
-        return str1 + separator + str2
-
-
-# message 模板
-message_template = {
-    "sender": {
-        "minecraft_name": "",
-        'minecraft_uuid': "",
-        "telegram_name": "",
-        "telegram_id": 0
-    },
-    "message": {
-        "id": 0,
-        "content": [
-        ]
-    }
+waypoint_names = {
+    'gui.xaero-deathpoint': '上次死亡地点',
+    'gui.xaero-deathpoint-old': '此前死亡地点',
 }
 
-sio = socketio.Client()
+
+def render_waypoint(world, fullname, single, x, y, z):
+    world_name = waypoint_world_names.get(world)
+    fullname = waypoint_names.get(fullname, fullname)
+    single_markdown = f'({tg_escape(single)})' if single else ''
+    single_plain = f'({single})' if single else ''
+    return (f'分享了一个来自 {world_name or tg_escape(world)} 的名为 *{tg_escape(fullname)}*{single_markdown} '
+            f'的路径点 `({x}, {y}, {z})`',
+            f'分享了一个来自 {world_name or world} 的名为 *{fullname}*{single_plain} 的路径点 `({x}, {y}, {z})`')
+
+
+def render_xaero_waypoint(match):
+    return render_waypoint(match.group('xaero_world'), match.group('xaero_name'), match.group('xaero_single'),
+                           match.group('xaero_x'), match.group('xaero_y'), match.group('xaero_z'))
+
+
+def render_journeymap_waypoint(match):
+    return render_waypoint(match.group('journeymap_dim'), match.group('journeymap_name') or '路径点', '',
+                           match.group('journeymap_x'), match.group('journeymap_y'), match.group('journeymap_z'))
+
+
+def render_chat_mention(match):
+    return f'@{tg_escape(match.group("mention_name"))}', f'@{match.group("mention_name")}'
+
+
+register_chat_transformer(
+    'xaero',
+    r'xaero-waypoint:(?P<xaero_name>.*?):(?P<xaero_single>.*?):(?P<xaero_x>\S+):(?P<xaero_y>\S+):(?P<xaero_z>\S+):'
+    r'.*?:.*?:.*?:(?P<xaero_world>\S+)',
+    render_xaero_waypoint)
+register_chat_transformer(
+    'journeymap',
+    r'\[(?:name:"(?P<journeymap_name>[^"]*)", )?x:(?P<journeymap_x>-?\d+), y:(?P<journeymap_y>-?\d+), '
+    r'z:(?P<journeymap_z>-?\d+)(?:, dim:(?P<journeymap_dim>[\w:./-]+))?\]',
+    render_journeymap_waypoint)
+register_chat_transformer('mention', r'<chat=[^>]*:<IC\^@(?P<mention_name>.*?)>:>', render_chat_mention)
+
+# 重连由 supervisor 负责
+sio = OrderedSocketIOClient(json=BridgeJSON, reconnection=False)
 
 
 @sio.event(namespace='/status')
@@ -695,14 +2928,13 @@ def on_message(data):
     logger.info({'收到 join 事件', data})
     data_json = json.loads(data)
     player_name = data_json['sender']['minecraft_name']
+    online_roster.join(player_name)
     player_id = get_id_by_mc_username(player_name)
-    if player_id:
-        if get_tg_username_by_id(player_id):
-            send_message(f'`{player_name}` ({get_tg_username_by_id(player_id)}) 加入了服务器')
-        else:
-            send_message(f'`{player_name}` 加入了服务器')
+    tg_name = get_tg_username_by_id(player_id)
+    if tg_name:
+        coalescer.add('join', f'`{player_name}` ({tg_name})')
     else:
-        send_message(f'`{player_name}` 加入了服务器')
+        coalescer.add('join', f'`{player_name}`')
 
 
 @sio.on('quit', namespace='/message')
@@ -710,14 +2942,13 @@ def on_message(data):
     logger.info({'收到 quit 事件', data})
     data_json = json.loads(data)
     player_name = data_json['sender']['minecraft_name']
+    online_roster.quit(player_name)
     player_id = get_id_by_mc_username(player_name)
-    if player_id:
-        if get_tg_username_by_id(player_id):
-            send_message(f'`{player_name}` ({get_tg_username_by_id(player_id)}) 离开了服务器')
-        else:
-            send_message(f'`{player_name}` 离开了服务器')
+    tg_name = get_tg_username_by_id(player_id)
+    if tg_name:
+        coalescer.add('quit', f'`{player_name}` ({tg_name})')
     else:
-        send_message(f'`{player_name}` 离开了服务器')
+        coalescer.add('quit', f'`{player_name}`')
 
 
 @sio.on('death', namespace='/message')
@@ -739,52 +2970,28 @@ def on_message(data):
     if len(death_dict) > 3:
         death_cause = death_dict[3]['content']
 
-    # 读取res/zh_cn.json
-    zh_cn_data = read_data('zh_cn', 'res')
-    death_format_value = zh_cn_data[death_format]
-
-    death_str = death_format_value
+    # 没有对应参数的占位符原样保留
+    death_args = [None, None, None]
     if player_id:
-        death_str = death_str.replace('%1$s', f'`{death_person}` ({get_tg_username_by_id(player_id)}) ')
+        death_args[0] = f'`{death_person}` ({get_tg_username_by_id(player_id)}) '
     else:
-        death_str = death_str.replace('%1$s', f'`{death_person}` ')
+        death_args[0] = f'`{death_person}` '
 
     if death_cause_person:
-        if death_cause_person in zh_cn_data.keys():
-            death_str = death_str.replace('%2$s', f' {zh_cn_data[death_cause_person]} ')
+        if has_translation(death_cause_person):
+            death_args[1] = f' {translate(death_cause_person)} '
         else:
             player_id2 = get_id_by_mc_username(death_cause_person)
             if player_id2:
-                death_str = death_str.replace('%2$s', f' `{death_cause_person}` ({get_tg_username_by_id(player_id2)}) ')
+                death_args[1] = f' `{death_cause_person}` ({get_tg_username_by_id(player_id2)}) '
             else:
-                death_str = death_str.replace('%2$s', f' `{death_cause_person}` ')
+                death_args[1] = f' `{death_cause_person}` '
         if death_cause:
-            death_str = death_str.replace('%3$s', f' `{death_cause}` ')
-    send_message(death_str)
+            death_args[2] = f' `{death_cause}` '
+    coalescer.add('notice', get_template(death_format).render(*death_args))
 
     # 死亡榜
-    death_all_data = read_data('death_all')
-    death_daily_data = read_data('death_daily')
-
-    if death_person in death_all_data.keys():
-        death_all_data[death_person] += 1
-    else:
-        death_all_data[death_person] = 1
-
-    # 判断是否为新的一天
-    if not death_daily_data.get('date') or datetime.now().strftime('%Y-%m-%d') != death_daily_data['date']:
-        death_daily_data = {
-            'date': datetime.now().strftime('%Y-%m-%d'),
-            'data': {}
-        }
-
-    if death_person in death_daily_data['data'].keys():
-        death_daily_data['data'][death_person] += 1
-    else:
-        death_daily_data['data'][death_person] = 1
-
-    write_data('death_all', death_all_data)
-    write_data('death_daily', death_daily_data)
+    death_stats.record(death_person, f'{death_format}|{death_cause_person}' if death_cause_person else death_format)
 
 
 @sio.on('chat', namespace='/message')
@@ -794,74 +3001,36 @@ def on_message(data):
     player_name = data_json['sender']['minecraft_name']
     player_id = get_id_by_mc_username(player_name)
 
-    if get_tg_username_by_id(player_id):
-        message_str = f'`{player_name}` ({get_tg_username_by_id(player_id)})：'
+    tg_name = get_tg_username_by_id(player_id)
+    if tg_name:
+        message_str = f'`{player_name}` ({tg_name})：'
     else:
         message_str = f'`{player_name}`：'
     reply_id = None
     return_message = ''
     is_mentioned = False
 
-    # 复制 message 模板
-    message_to_send = copy.deepcopy(message_template)
-
-    message_to_send['sender']['minecraft_name'] = player_name
-    message_to_send['sender']['telegram_name'] = get_tg_username_by_id_noformat(
-        get_id_by_mc_username(player_name)) or 'UNBOUND'
-    message_to_send['sender']['telegram_id'] = get_id_by_mc_username(player_name) or 0
+    message_to_send = BridgeMessage(player_name, get_tg_username_by_id_noformat(player_id) or 'UNBOUND',
+                                    player_id or 0)
 
     for message_content in data_json['message']['content']:
         if message_content['type'] == 'text':
-            xaero_waypoint_pattern = r'xaero-waypoint:(.*?):(.*?):(\S+):(\S+):(\S+):.*?:.*?:.*?:(\S+)'
-            xaero_waypoint_match = re.search(xaero_waypoint_pattern, message_content['content'])
-
-            at_pattern = r'<chat=[^>]*:<IC\^@(.*?)>:>'
-            at_match = re.search(at_pattern, message_content['content'])
-
-            if xaero_waypoint_match:
-                fullname = xaero_waypoint_match.group(1)
-                single = xaero_waypoint_match.group(2)
-                x = xaero_waypoint_match.group(3)
-                y = xaero_waypoint_match.group(4)
-                z = xaero_waypoint_match.group(5)
-                world = xaero_waypoint_match.group(6)
-
-                if world == 'Internal-overworld-waypoints':
-                    world = '主世界'
-                elif world == 'Internal-the-nether-waypoints':
-                    world = '下界'
-                elif world == 'Internal-the-end-waypoints':
-                    world = '末地'
-                else:
-                    world = tg_escape(world)
-
-                if fullname == 'gui.xaero-deathpoint':
-                    fullname = '上次死亡地点'
-                elif fullname == 'gui.xaero-deathpoint-old':
-                    fullname = '此前死亡地点'
-
-                message_str += f'分享了一个来自 {world} 的名为 *{tg_escape(fullname)}*({tg_escape(single)}) 的路径点 `({x}, {y}, {z})`'
-                return_message += f'分享了一个来自 {world} 的名为 *{fullname}*({single}) 的路径点 `({x}, {y}, {z})`'
-            else:
-                if at_match:
-                    message_content['content'] = re.sub(at_pattern, f'@{at_match.group(1)}',
-                                                        message_content['content'])
-
-                message_str += tg_escape(message_content['content'])
-                return_message += message_content['content']
+            markdown, plain = transform_chat_text(message_content['content'])
+            message_str += markdown
+            return_message += plain
         elif message_content['type'] == 'at':
             tg_id = message_content['id']
             if tg_id == 0:
                 return  # 如果要@的tg id是0就不处理
-            userinfo = bot.get_chat(tg_id)
-            tg_username = userinfo.username
+            profile = get_tg_profile(tg_id)
+            tg_username = profile['username'] if profile else None
             if tg_username:
                 tg_username = tg_escape(tg_username)
                 message_str += f'@{tg_username} '
             else:
-                tg_username = tg_escape(userinfo.first_name)
+                tg_username = tg_escape(profile['first_name'] if profile else str(tg_id))
                 message_str += f' [@{tg_username}](tg://user?id={tg_id}) '
-            message_to_send['message']['content'].append({
+            message_to_send.content.append({
                 'type': 'at',
                 'id': tg_id,
                 'content': tg_username,
@@ -872,70 +3041,71 @@ def on_message(data):
             reply_id = message_content['id']
 
     if reply_id:
-        sent_message = bot.send_message(group_id, message_str, reply_to_message_id=reply_id,
-                                        disable_web_page_preview=True)
-
-        # logger.info(sent_message)
-
-        content_type_zh = {
-            'photo': '图片',
-            'video': '视频',
-            'audio': '音频',
-            'voice': '语音',
-            'sticker': '贴纸',
-            'document': '文件',
-        }
+        # 发送成功之后再把带回复内容的消息发回服务器
+        def on_sent(sent_message):
+            content_type_zh = {
+                'photo': '图片',
+                'video': '视频',
+                'audio': '音频',
+                'voice': '语音',
+                'sticker': '贴纸',
+                'document': '文件',
+            }
 
-        reply_str = ''
-
-        if sent_message.reply_to_message.content_type == 'text':
-            reply_str = sent_message.reply_to_message.text
-        # 判断是否在列表中
-        elif sent_message.reply_to_message.content_type in content_type_zh.keys():
-            reply_str = '[' + content_type_zh[sent_message.reply_to_message.content_type] + ']'
-
-            if sent_message.reply_to_message.content_type == 'photo':
-                file = bot.get_file(sent_message.reply_to_message.photo[-1].file_id)
-                reply_str += ' (' + file.file_path + ')'
-            elif sent_message.reply_to_message.content_type == 'video':
-                reply_str += ' (' + sent_message.reply_to_message.video.file_name + ')'
-            elif sent_message.reply_to_message.content_type == 'audio':
-                reply_str += ' (' + sent_message.reply_to_message.audio.file_name + ')'
-            elif sent_message.reply_to_message.content_type == 'document':
-                reply_str += ' (' + sent_message.reply_to_message.document.file_name + ')'
-            elif sent_message.reply_to_message.content_type == 'sticker':
-                reply_str += ' ' + sent_message.reply_to_message.sticker.emoji
-
-            if sent_message.reply_to_message.caption:
-                reply_str += ' ' + sent_message.reply_to_message.caption
-
-        message_to_send['message']['id'] = sent_message.message_id
-        message_to_send['message']['content'].extend([{
-            'type': 'reply',
-            'id': reply_id,
-            'content': reply_str,
-        }, {
-            'type': 'text',
-            'id': sent_message.message_id,
-            'content': return_message,
-        }])
-        sio.emit('chat', message_to_send, namespace='/message')
-        logger.info('websocket 发送消息 ' + json.dumps(message_to_send))
-        logger.info({'return to server (reply)', reply_id, return_message})
-    else:
-        # print(group_id, message_str)
-        sent_message = bot.send_message(group_id, message_str, disable_web_page_preview=True)
-        message_to_send['message']['id'] = sent_message.message_id
-        if is_mentioned:
-            message_to_send['message']['content'].append({
+            reply_str = ''
+
+            if sent_message.reply_to_message.content_type == 'text':
+                reply_str = sent_message.reply_to_message.text
+            # 判断是否在列表中
+            elif sent_message.reply_to_message.content_type in content_type_zh.keys():
+                reply_str = '[' + content_type_zh[sent_message.reply_to_message.content_type] + ']'
+
+                if sent_message.reply_to_message.content_type == 'photo':
+                    reply_str += reply_photo_path(sent_message.reply_to_message.photo[-1])
+                elif sent_message.reply_to_message.content_type == 'video':
+                    reply_str += ' (' + sent_message.reply_to_message.video.file_name + ')'
+                elif sent_message.reply_to_message.content_type == 'audio':
+                    reply_str += ' (' + sent_message.reply_to_message.audio.file_name + ')'
+                elif sent_message.reply_to_message.content_type == 'document':
+                    reply_str += ' (' + sent_message.reply_to_message.document.file_name + ')'
+                elif sent_message.reply_to_message.content_type == 'sticker':
+                    reply_str += ' ' + sent_message.reply_to_message.sticker.emoji
+
+                if sent_message.reply_to_message.caption:
+                    reply_str += ' ' + sent_message.reply_to_message.caption
+
+            message_to_send.id = sent_message.message_id
+            message_to_send.content.extend([{
+                'type': 'reply',
+                'id': reply_id,
+                'content': reply_str,
+            }, {
+                'type': 'text',
+                'id': sent_message.message_id,
+                'content': return_message,
+            }])
+            send_chat(message_to_send)
+            logger.info({'return to server (reply)', reply_id, return_message})
+
+        # 先把还在合并的聊天发出去，保持和游戏里一样的顺序
+        coalescer.flush('chat')
+        send_message(message_str, priority=PRIORITY_CHAT, callback=on_sent, reply_to_message_id=reply_id)
+    elif is_mentioned:
+        def on_sent(sent_message):
+            message_to_send.id = sent_message.message_id
+            message_to_send.content.append({
                 'type': 'text',
                 'id': sent_message.message_id,
                 'content': return_message,
             })
-            sio.emit('chat', message_to_send, namespace='/message')
-            logger.info('websocket 发送消息 ' + json.dumps(message_to_send))
+            send_chat(message_to_send)
             logger.info({'return to server (send)', message_str, return_message})
 
+        coalescer.flush('chat')
+        send_message(message_str, priority=PRIORITY_CHAT, callback=on_sent)
+    else:
+        coalescer.add('chat', message_str)
+
 
 @sio.on('advancement', namespace='/message')
 def on_message(data):
@@ -951,49 +3121,29 @@ def on_message(data):
     advancement_title = advancement_dict[1]['content']
     advancement_description = advancement_dict[2]['content']
 
-    # 读取res/zh_cn.json
-    zh_cn_data = read_data('zh_cn', 'res')
-    # 获取advancement_format对应的值
-    advancement_format_value = zh_cn_data[advancement_format]
+    # 获取advancement_format对应的模板
+    advancement_template = get_template(advancement_format)
     if player_id:
-        adv_str = advancement_format_value % (
-            f'`{player_name}` ({get_tg_username_by_id(player_id)}) ', f" \[*{zh_cn_data[advancement_title]}*]")
-        adv_str += f'\n —— _{zh_cn_data[advancement_description]}_'
-        send_message(adv_str)
+        adv_str = advancement_template.render(
+            f'`{player_name}` ({get_tg_username_by_id(player_id)}) ', f" \[*{translate(advancement_title)}*]")
     else:
-        adv_str = advancement_format_value % (f'`{player_name}` ', f" \[*{zh_cn_data[advancement_title]}*]")
-        adv_str += f'\n —— _{zh_cn_data[advancement_description]}_'
-        send_message(adv_str)
+        adv_str = advancement_template.render(f'`{player_name}` ', f" \[*{translate(advancement_title)}*]")
+    adv_str += f'\n —— _{translate(advancement_description)}_'
+    coalescer.add('notice', adv_str)
 
 
 @sio.on('players', namespace='/status')
 def on_message(data):
     logger.info({'收到 players 事件', data})
-    data_json = json.loads(data)
-    res_str = f'当前在线玩家数: {str(data_json["current"])} / {str(data_json["maximum"])}'
-    # 判断玩家列表是否为空
-    if len(data_json['players']) > 0:
-        res_str += '\n玩家列表:\n'
-        players_str = ''
-        for player in data_json['players']:
-            player_id = get_id_by_mc_username(player['name'])
-            if player_id:
-                players_str = set_str_if_empty(players_str,
-                                               f'`{player["name"]}` ({get_tg_username_by_id(player_id)})',
-                                               ', ')
-            else:
-                players_str = set_str_if_empty(players_str, '`' + player["name"] + '`', ', ')
-        res_str += players_str
-    send_message(res_str)
+    # 定时校正的查询没有人在等，只更新在线名单
+    players_query.resolve(data)
 
 
 @sio.on('performance', namespace='/status')
 def on_message(data):
     logger.info({'收到 performance 事件', data})
-    data_json = json.loads(data)
-    res_str = f'TPS: {str(round(data_json["tps"], 3))}\n' \
-              f'MSPT: {str(round(data_json["mspt"], 3))}\n'
-    send_message(res_str)
+    if not performance_query.resolve(data):
+        logger.info('没有等待中的 performance 查询')
 
 
 @sio.on('*', namespace='/status')
@@ -1006,86 +3156,423 @@ def catch_all(event, data):
     logger.info({'message 收到更多事件', event, data})
 
 
-connecting = False
-
-
 @sio.event(namespace='/status')
 def connect():
-    global tried, connecting
-    tried = False
-    connecting = False
     logger.info("status 已连接")
-    bot.send_message(config['admin_id'], 'status 已连接')
+    send_admin('status 已连接')
+    # 两个 namespace 都连上之后校正一次在线名单
+    if supervisor.up('/status'):
+        sync_roster()
 
 
 @sio.event(namespace='/message')
 def connect():
-    global tried, connecting
-    tried = False
-    connecting = False
     logger.info("message 已连接")
-    bot.send_message(config['admin_id'], 'message 已连接')
+    send_admin('message 已连接')
+    if supervisor.up('/message'):
+        sync_roster()
 
 
+# 连接失败由 supervisor 通知管理员，这里只记录日志
 @sio.event(namespace='/status')
 def connect_error(data):
-    global connecting
-    connecting = False
     logger.error({'status 连接出错', data})
-    bot.send_message(config['admin_id'], 'status 连接出错\n```\n' + str(data) + '\n```')
 
 
 @sio.event(namespace='/message')
 def connect_error(data):
-    global connecting
-    connecting = False
     logger.error({'message 连接出错', data})
-    bot.send_message(config['admin_id'], 'message 连接出错\n```\n' + str(data) + '\n```')
 
 
 @sio.event(namespace='/status')
 def disconnect():
     logger.error("status 断开连接")
-    bot.send_message(config['admin_id'], 'status 断开连接')
+    send_admin('status 断开连接')
+    supervisor.down('/status')
 
 
 @sio.event(namespace='/message')
 def disconnect():
+    online_roster.unsync()
     logger.error("message 断开连接")
-    bot.send_message(config['admin_id'], 'message 断开连接')
+    send_admin('message 断开连接')
+    supervisor.down('/message')
 
 
 def ws_connect():
-    global connecting
-    if connecting:
-        return
-    logger.info('连接 websocket')
-    ws_url = config['websocket_url']
-    sio.connect(ws_url, namespaces=['/status', '/message'])
+    if runtime_mode == 'asyncio':
+        asyncio.run_coroutine_threadsafe(asio.connect(config['websocket_url'], namespaces=['/status', '/message']),
+                                         loop).result()
+    else:
+        sio.connect(config['websocket_url'], namespaces=['/status', '/message'])
+
+
+def ws_disconnect():
+    if runtime_mode == 'asyncio':
+        asyncio.run_coroutine_threadsafe(asio.disconnect(), loop).result()
+    else:
+        sio.disconnect()
 
 
-tried = False
+reconnect_config = config.get('reconnect') or {}
+supervisor = ConnectionSupervisor(['/status', '/message'], ws_connect, ws_disconnect,
+                                  lambda event, data, namespace: emit(event, data, namespace=namespace),
+                                  socket_connected,
+                                  reconnect_config.get('min_delay', 1), reconnect_config.get('max_delay', 300),
+                                  reconnect_config.get('buffer_size', 200), reconnect_config.get('connect_timeout', 30))
 
 
-def ws_reconnect():
-    global tried
-    if not tried:
-        tried = True
-        sio.disconnect()
-        time.sleep(5)
-        ws_connect()
-    else:
-        bot.send_message(config['admin_id'], 'socket 重连失败')
+# uptime 推送（Uptime Kuma），在 background_pool 里执行
+# 复用同一个连接，上一次推送没结束就跳过这一次，推送地址卡住也不会占满线程池
+uptime_session = requests.Session()
+uptime_lock = threading.Lock()
 
 
-ws_connect()
+# 返回 (status, msg, ping)：socket 是否连接、Telegram API 往返时间（毫秒）、发送队列长度
+def check_health():
+    socket_ok = supervisor.connected()
+    start = time.monotonic()
+    try:
+        bot.get_me()
+        ping = round((time.monotonic() - start) * 1000)
+    except Exception as e:
+        logger.error({'Telegram API 检查失败', str(e)})
+        ping = None
+    status = 'up' if socket_ok and ping is not None else 'down'
+    msg = f'socket {"已连接" if socket_ok else "未连接"}，Telegram {"正常" if ping is not None else "出错"}，' \
+          f'发送队列 {outbound.qsize()}'
+    return status, msg, ping
 
-uptime = config['uptime']
-if uptime:
-    if uptime['enable']:
-        interval = uptime['interval']
-        url = uptime['url']
-        logger.info(f'启用 uptime，每隔 {interval} 秒请求一次 {url}')
-        while True:
-            requests.get(url)
-            time.sleep(interval)
+
+def push_uptime(url, timeout):
+    if not uptime_lock.acquire(blocking=False):
+        logger.warning('上一次 uptime 推送还没结束，跳过')
+        return
+    try:
+        status, msg, ping = check_health()
+        # 配置的地址里自带的 status、msg、ping 换成实际的值
+        parsed = urlparse(url)
+        params = [(k, v) for k, v in parse_qsl(parsed.query) if k not in ('status', 'msg', 'ping')]
+        params += [('status', status), ('msg', msg)]
+        if ping is not None:
+            params.append(('ping', ping))
+        uptime_session.get(parsed._replace(query=urlencode(params)).geturl(), timeout=(5, timeout))
+    except Exception as e:
+        logger.error({'uptime 推送失败', str(e)})
+    finally:
+        uptime_lock.release()
+
+
+def start_uptime():
+    uptime = config['uptime']
+    if uptime:
+        if uptime['enable']:
+            interval = uptime['interval']
+            url = uptime['url']
+            logger.info(f'启用 uptime，每隔 {interval} 秒请求一次 {url}')
+            scheduler.call_every(interval, background_pool.submit, push_uptime, url, min(interval, 10), delay=0)
+
+
+# 异步模式下，处理函数需要的网络数据（用户资料）先由协程并发预取到缓存里，
+# 再在事件循环里运行同一份处理逻辑（只读缓存、只放进发送队列，不会阻塞）
+async def prefetch_profiles(user_ids):
+    await asyncio.gather(*(aget_tg_profile(user_id) for user_id in set(user_ids) if user_id))
+
+
+def message_profile_ids(message_local):
+    user_ids = [message_local.from_user.id]
+    for entity in (message_local.entities or []) + (message_local.caption_entities or []):
+        if entity.type == 'text_mention':
+            user_ids.append(entity.user.id)
+    command = telebot.util.extract_command(message_local.text or '')
+    if command == 'bind':
+        user_ids.append(get_id_by_mc_username(message_local.text[6:]))
+    elif command == 'list':
+        # 名单在处理事件的线程里修改，拿着锁复制一份
+        with online_roster.lock:
+            names = list(online_roster.players)
+        user_ids += [get_id_by_mc_username(name) for name in names]
+    elif command == 'recent':
+        user_ids += [get_id_by_mc_username(name) for name in online_roster.recent(3600)]
+    elif command in death_list_windows:
+        user_ids += [get_id_by_mc_username(name) for name, count in death_stats.top(death_list_windows[command][0])]
+    return user_ids
+
+
+def event_profile_ids(event, data):
+    if event not in ('join', 'quit', 'death', 'advancement', 'chat', 'players'):
+        return []
+    data_json = json.loads(data)
+    if event == 'players':
+        return [get_id_by_mc_username(player['name']) for player in data_json['players']]
+    user_ids = [get_id_by_mc_username(data_json['sender']['minecraft_name'])]
+    content = data_json['message']['content']
+    if event == 'chat':
+        user_ids += [message_content['id'] for message_content in content if message_content['type'] == 'at']
+    elif event == 'death' and len(content) > 2:
+        user_ids.append(get_id_by_mc_username(content[2]['content']))
+    return user_ids
+
+
+# 异步模式下按 key 排队，和线程模式的 KeyedExecutor 一样，同一个聊天 / 同一个 namespace 按收到的顺序处理
+# AsyncTeleBot 用 gather 同时运行一批更新的处理函数，各自预取资料的时间不同，不排队的话顺序会乱
+# asyncio.Lock 按等待的先后唤醒；只在事件循环里使用，不需要线程锁
+class AsyncKeyedLock:
+    def __init__(self):
+        # key -> [锁, 正在使用或等待的数量]，没人用的 key 会删掉
+        self.locks = {}
+
+    async def run(self, key, func, *args):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await func(*args)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+
+async_handler_lock = AsyncKeyedLock()
+
+
+def async_message_handler(handler):
+    async def process(message_local):
+        await prefetch_profiles(message_profile_ids(message_local))
+        await loop.run_in_executor(handler_pool, handler, message_local)
+
+    async def wrapper(message_local):
+        try:
+            await async_handler_lock.run(('telegram', message_local.chat.id), process, message_local)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+
+    return wrapper
+
+
+def async_event_handler(namespace, event, handler):
+    arg_count = handler_arg_count(handler)
+
+    async def process(*args):
+        if event != '*' and args:
+            await prefetch_profiles(event_profile_ids(event, args[0]))
+        elif event == '*' and len(args) > 1:
+            await prefetch_profiles(event_profile_ids(args[0], args[1]))
+        await loop.run_in_executor(handler_pool, handler, *(args if arg_count is None else args[:arg_count]))
+
+    async def wrapper(*args):
+        try:
+            await async_handler_lock.run(('socket', namespace), process, *args)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+
+    return wrapper
+
+
+# 把线程模式下注册的处理函数原样注册到异步的 bot 和 socket.io 客户端上
+def register_async_handlers():
+    for handler in bot.message_handlers:
+        abot.register_message_handler(async_message_handler(handler['function']), **handler['filters'])
+    for namespace, handlers in sio.handlers.items():
+        for event, handler in handlers.items():
+            asio.on(event, async_event_handler(namespace, event, handler), namespace=namespace)
+
+
+profiling_config = config.get('profiling') or {}
+slow_handler_seconds = profiling_config.get('slow_handler_ms', 200) / 1000
+
+
+# 处理函数超过 slow_handler_ms 时记录一条警告，附上各个子调用的次数和耗时
+def log_slow_handler(name, elapsed, breakdown):
+    if elapsed < slow_handler_seconds:
+        return
+    parts = [f'{sub} {count}次 {seconds * 1000:.1f}ms'
+             for sub, (count, seconds) in sorted(breakdown.items(), key=lambda item: -item[1][1])]
+    other = elapsed - sum(seconds for count, seconds in breakdown.values())
+    parts.append(f'其他 {other * 1000:.1f}ms')
+    logger.warning(f'处理函数太慢 {name} {elapsed * 1000:.1f}ms：' + '，'.join(parts))
+
+
+# 统计每个处理函数的调用次数和耗时，慢的记录子调用明细
+def timed_telegram_handler(handler):
+    def wrapper(message_local, *args, **kwargs):
+        command = telebot.util.extract_command(message_local.text or '') if message_local.content_type == 'text' \
+            else None
+        if command:
+            metrics.inc('telegram_commands_total', {'command': command})
+        else:
+            metrics.inc('telegram_messages_total', {'content_type': message_local.content_type})
+        name = 'telegram:' + (command or handler.__name__)
+        previous = tracer.begin()
+        start = time.monotonic()
+        try:
+            return handler(message_local, *args, **kwargs)
+        finally:
+            elapsed = time.monotonic() - start
+            metrics.observe('handler_seconds', elapsed, {'handler': 'telegram:' + handler.__name__})
+            log_slow_handler(name, elapsed, tracer.end(previous))
+
+    return wrapper
+
+
+def timed_event_handler(namespace, event, handler):
+    arg_count = handler_arg_count(handler)
+
+    def wrapper(*args):
+        # 通配的处理函数第一个参数是事件名
+        name = args[0] if event == '*' and args else event
+        metrics.inc('socket_events_total', {'namespace': namespace, 'event': name})
+        previous = tracer.begin()
+        start = time.monotonic()
+        try:
+            return handler(*(args if arg_count is None else args[:arg_count]))
+        finally:
+            elapsed = time.monotonic() - start
+            metrics.observe('handler_seconds', elapsed, {'handler': f'socket:{namespace}:{event}'})
+            log_slow_handler(f'socket:{namespace}:{name}', elapsed, tracer.end(previous))
+
+    return wrapper
+
+
+def instrument_handlers():
+    for handler in bot.message_handlers:
+        handler['function'] = timed_telegram_handler(handler['function'])
+    for namespace, handlers in sio.handlers.items():
+        for event, handler in handlers.items():
+            handlers[event] = timed_event_handler(namespace, event, handler)
+
+
+metrics.describe('telegram_api_seconds', 'histogram', 'Bot API 请求耗时（秒）')
+metrics.describe('telegram_api_requests_total', 'counter', 'Bot API 请求数，按方法和 HTTP 状态码')
+metrics.describe('telegram_commands_total', 'counter', '收到的 Telegram 命令数')
+metrics.describe('telegram_messages_total', 'counter', '收到的 Telegram 普通消息数，按类型')
+metrics.describe('socket_events_total', 'counter', '收到的 socket.io 事件数')
+metrics.describe('handler_seconds', 'histogram', '处理函数耗时（秒）')
+metrics.describe('store_reads_total', 'counter', 'json 文件读取次数')
+metrics.describe('store_writes_total', 'counter', 'json 文件写入次数')
+metrics.describe('socket_connected', 'gauge', 'socket.io namespace 是否已连接')
+metrics.describe('socket_buffered_messages', 'gauge', '断线期间缓存的待发送消息数')
+metrics.describe('socket_reconnect_failures', 'gauge', '连续重连失败次数')
+metrics.describe('outbound_queue_size', 'gauge', 'Telegram 发送队列长度')
+metrics.describe('online_players', 'gauge', '在线玩家数')
+metrics.gauge('socket_connected', lambda: {(('namespace', namespace),): int(namespace in supervisor.connected_namespaces)
+                                           for namespace in sorted(supervisor.namespaces)})
+metrics.gauge('socket_buffered_messages', lambda: {(): len(supervisor.buffer)})
+metrics.gauge('socket_reconnect_failures', lambda: {(): supervisor.failures})
+metrics.gauge('outbound_queue_size', lambda: {(): outbound.qsize()})
+metrics.gauge('online_players', lambda: {(): len(online_roster.players)})
+
+
+# 本地的指标导出接口，GET /metrics
+def start_metrics_server(listen, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((listen, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f'指标导出 http://{listen}:{port}/metrics')
+
+
+# socket.io 的处理函数按 namespace 交给 handler_executor，同一个 namespace 的事件按顺序处理
+def ordered_event_handler(namespace, handler):
+    arg_count = handler_arg_count(handler)
+
+    def wrapper(*args):
+        handler_executor.submit(('socket', namespace), handler, *(args if arg_count is None else args[:arg_count]))
+
+    return wrapper
+
+
+def order_socket_handlers():
+    for namespace, handlers in sio.handlers.items():
+        for event, handler in handlers.items():
+            handlers[event] = ordered_event_handler(namespace, handler)
+
+
+webhook_config = config.get('webhook') or {}
+
+
+# 启动 webhook 服务器并向 Telegram 注册，process 用来处理收到的更新
+def start_webhook(process):
+    url = webhook_config['url']
+    logger.info(f'telegram 启用 webhook {url}')
+    # 没有配置 secret token 时每次启动随机生成一个，不接受没有校验的请求
+    secret_token = webhook_config.get('secret_token')
+    if not secret_token:
+        secret_token = secrets.token_urlsafe(32)
+        logger.info('webhook 没有配置 secret_token，已随机生成')
+    webhook_server = WebhookServer(webhook_config.get('listen', '0.0.0.0'), webhook_config.get('port', 8443),
+                                   urlparse(url).path or '/', secret_token, process,
+                                   webhook_config.get('workers', 4), webhook_config.get('queue_size', 100))
+    webhook_server.start()
+    bot.set_webhook(url=url, secret_token=secret_token)
+
+
+metrics_config = config.get('metrics') or {}
+
+
+def start_metrics():
+    if metrics_config.get('enable'):
+        start_metrics_server(metrics_config.get('listen', '127.0.0.1'), metrics_config.get('port', 9108))
+
+
+def run_threaded():
+    instrument_handlers()
+    start_metrics()
+    outbound.start()
+    status_poller.start(status_config.get('interval', 30))
+    scheduler.call_every(config.get('roster_sync_interval', 300), sync_roster)
+    if webhook_config.get('enable'):
+        start_webhook(bot.process_new_updates)
+    else:
+        threading.Thread(target=tg_polling).start()
+    send_admin('机器人，启动！')
+    order_socket_handlers()
+    supervisor.start()
+    start_uptime()
+    # 主线程结束后线程池就不再接受新任务了，一直等到收到退出信号
+    threading.Event().wait()
+
+
+async def run_asyncio():
+    instrument_handlers()
+    start_metrics()
+    register_async_handlers()
+    outbound.start()
+    status_poller.start(status_config.get('interval', 30))
+    scheduler.call_every(config.get('roster_sync_interval', 300), sync_roster)
+    send_admin('机器人，启动！')
+    start_uptime()
+    supervisor.start()
+    if webhook_config.get('enable'):
+        # webhook 线程把更新交给事件循环处理，等处理完再取下一个，队列满了就会返回 503
+        start_webhook(lambda updates: asyncio.run_coroutine_threadsafe(abot.process_new_updates(updates),
+                                                                       loop).result())
+        await asyncio.Event().wait()
+    else:
+        logger.info('telegram 启动轮询（asyncio）')
+        await abot.remove_webhook()
+        await abot.infinity_polling(logger_level=None)
+
+
+if runtime_mode == 'asyncio':
+    loop.run_until_complete(run_asyncio())
+else:
+    run_threaded()